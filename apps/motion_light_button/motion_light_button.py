@@ -1,132 +1,334 @@
-import appdaemon.plugins.hass.hassapi as hassapi
-import time, importlib
-import grug_timeout
-# importlib.reload( shared.timeout )
-
-"""
-    Motion activated light with extra button.
-
-    sensors:        A list of motion sensors, as HA entities.
-    light:          Light entity to control.
-    motion_delay:   Time to keep the light on after motion is no longer detected
-    button_delay:   Time to keep the light on after the button is pressed
-    timeout:        To turn off the light if the motion sensor stays stuck in ON state 
-
-    set log_level DEBUG in this app's yaml config for logging.
-"""
-
-class MotionLightButtonActor:
-    def __init__( self, api, name, sensors, light, **kwargs ):
-        self.api    = api
-        self.name   = name
-        self.light  = light
-        self.args   = kwargs
-
-        self.timer = grug_timeout.DelayedCallback( api, lambda: self.light_off("Timer"), self.name+".timer" )      # normal timer to turn off the light
-        self.timeout = grug_timeout.DelayedCallback( api, lambda: self.light_off("Timeout"), self.name+".timeout" )  # stuck motion detector timeout
-        self.timer.load()       # load() may call the callback if timer expired, so both timers have to be
-        self.timeout.load()     # initialized before calling load()
-        self.api.log("Timer remaining: %ss Timeout remaining: %ss", self.timer.remaining(), self.timeout.remaining())
-        self.light_state_we_set = None      # remember if it was us who set the light
-        
-        self.sensor_state = {}
-        self.sensors = sensors
-        for sensor in sensors:
-            api.listen_state( self.on_sensor, sensor )  # motion detector
-        api.listen_state( self.on_light, light )    # relay state change from wired button
-
-        # if light is on at app start, remember to turn it off
-        if self.api.get_state( self.light ) == "on":
-            self.timer.set( self.args["button_delay"] )
-
-    def initialize( self ):
-        pass
-
-    def terminate(self):
-        self.timer.cancel()
-    
-    "Turn the light off and remember we turned it off"
-    def light_off( self, reason="" ):
-        if self.api.get_state( self.light ) != "off":
-            self.api.log( "OFF %s", reason )
-        else:
-            self.debug( "OFF %s", reason )
-        self.timeout.reset()
-        self.light_state_we_set = "off"
-        self.api.turn_off( self.light )
-
-    "Turn the light on and remember we turned it on"
-    def light_on( self, reason="" ):
-        if self.api.get_state( self.light ) != "on":
-            self.api.log( "ON %s", reason )
-        else:
-            self.debug( "ON %s", reason )
-        self.light_state_we_set = "on"
-        self.api.turn_on( self.light )
-    
-    """Motion sensor state change
-    
-    If the light was turned off by the button, the sensor in front of the
-    button reports occupancy, so it will not send new events until cleared.
-    This allows leaving the room after turning the lights off with the button.
-    
-    But if someone comes from the other end of the corridor and activates another
-    sensor, we want the lights to turn on. So we can't use a composite/group sensor,
-    because that would already be on due to  the person pushing the button.
-
-    Instead we have to check events from each sensor.
-    """
-    def on_sensor( self, entity, attribute, old, new, kwargs ):
-        old_states = [ self.sensor_state.get(id) for id in self.sensors ]
-        self.sensor_state[ entity ] = new
-        new_states = [ self.sensor_state.get(id) for id in self.sensors ]
-        self.debug( "on_sensor %s (%s -> %s) states %s -> %s", entity, old, new, old_states, new_states )
-      
-        #   Any sensor state change to "occupancy on" will turn on the lights
-        if new == "on":               # presence detected
-            self.timer.cancel()       # stop countdown, this does not clear the expiry time
-            self.timeout.set( self.args["timeout"] )
-            self.light_on( "from sensor" )           # so the timer remembers if it was set by the button or sensor
-
-        #   Turn off only when all sensors do not report "on" (ie, "off" or "unavailable")
-        elif "on" not in new_states:
-            # if self.api.get_state( self.light ) == "on":
-            self.timeout.reset()      # cancel stuck motion detector timeout
-            self.timer.at_least( self.args["motion_delay"] )    # Begin countdown. This will not shorten the timeout set by the button.
-            self.api.log( "Timer %ss", self.timer.remaining() )
-
-    """
-    Relay state change, either from zigbee command or pushbutton wired to relay input.
-    """
-    def on_light( self, entity, attribute, old, new, kwargs ):
-        if new == self.light_state_we_set:
-            # We caused this state change, ignore it.
-            return
-        
-        # Relay state change is from pushbutton wired to relay input.
-        self.light_state_we_set = None
-        self.api.log( "%s: %s -> %s", entity, old, new )
-        if new == "on":
-            # light turned on by button: prolong timeout by button_delay
-            self.timeout.reset()
-            self.timer.at_least( self.args["button_delay"] )
-        else:
-            # light turned off by button. Cancel timer and reset expiry time.
-            self.timeout.reset()
-            self.timer.reset()
-
-    def debug( self, fmt, *args ):
-        self.api.log( fmt, *args, level="DEBUG" )
-
-#   Using separate class here, to avoid conflicts between hassapi.Hass
-#   member functions and variable and our own class stuff.
-#
-class MotionLightButton(hassapi.Hass):
-    def initialize(self):
-        self.depends_on_module( grug_timeout )
-        self.__actor = MotionLightButtonActor( self, **self.args )
-        self.__actor.initialize()
-
-    def terminate(self):
-        self.__actor.terminate()
-
+import appdaemon.plugins.hass.hassapi as hassapi
+import time, importlib
+import grug_timeout, grug_persist, grug_state, grug_command, grug_sensors, grug_metrics, grug_rooms, grug_handoff, grug_reconcile, grug_trace, grug_machine
+# importlib.reload( shared.timeout )
+
+"""
+    Motion activated light with extra button.
+
+    sensors:        A list of motion sensors, as HA entities.
+    light:          Light entity to control.
+    motion_delay:   Time to keep the light on after motion is no longer detected
+    button_delay:   Time to keep the light on after the button is pressed
+    timeout:        To turn off the light if the motion sensor stays stuck in ON state 
+    debounce:       Optional debounce window for flapping sensors, in seconds
+                    or as { sensor: seconds }, see grug_sensors.
+    rooms:          Optional list of rooms hosted by this app, each with
+                    the keys above, see grug_rooms.
+
+    set log_level DEBUG in this app's yaml config for logging. Debug messages
+    are also kept in memory and can be dumped, see grug_trace.
+"""
+
+"""
+    The state is who set the light last: "on" or "off" by us, so the state
+    change that follows is only the echo of our command, or "manual" when
+    the wired pushbutton or someone else did (and when the app starts).
+"""
+MACHINE = """
+states:  [ "on", "off", manual ]
+initial: manual
+transitions:
+  # presence: command first, timers after
+  - { from: "*", event: sensor_on, do: [ presence ], to: "on" }
+  # all sensors clear, begin countdown
+  - { from: "*", event: clear, do: [ clear ] }
+  # echoes of our own commands
+  - { from: "on",  event: light_on }
+  - { from: "off", event: light_off }
+  # relay state change from the pushbutton wired to the relay input
+  - { from: "*", event: light_on, do: [ manual, button_on ], to: manual }
+  - { from: "*", event: [ light_off, light_other ], do: [ manual, button_off ], to: manual }
+  - { from: "*", event: [ timer, timeout ], do: [ light_off ], to: "off" }
+"""
+
+class MotionLightButtonActor( grug_persist.PersistMixin ):
+    """
+        Persisted record, by schema version "v":
+        1   each timer in an entity of its own, ".timer" and ".timeout"
+        2   { "timer": {...}, "timeout": {...} }, both timers in one record,
+            as returned by Timeout.pack()
+    """
+    SCHEMA = 2
+    loading = False     # True while the timers are unpacked, they are saved once done
+
+    def __init__( self, api, name, sensors, light, **kwargs ):
+        self.api    = api
+        self.name   = name
+        self.prefix = grug_rooms.log_prefix( api.args, name )
+        self.light  = light
+        self.args   = kwargs
+        self.metrics = m = grug_metrics.register( api, name )
+        self.tracer = grug_trace.register( api, name, self.prefix )
+        grug_reconcile.register( api )
+
+        self.entity_storage_id = self.name + ".storage"
+        self.timer = grug_timeout.DelayedCallbackF( api, m.timed( lambda: self.fire( "timer", "Timer" )), self.save )        # normal timer to turn off the light
+        self.timeout = grug_timeout.DelayedCallbackF( api, m.timed( lambda: self.fire( "timeout", "Timeout" )), self.save )  # stuck motion detector timeout
+        handed_over = self.resume()
+        self.log("Timer remaining: %ss Timeout remaining: %ss", self.timer.remaining(), self.timeout.remaining())
+        
+        self.sensors = grug_sensors.subscribe( api, sensors, m.timed( self.on_sensor, latency=True ), self.args.get( "debounce", 0 ))     # motion detectors
+        api.listen_state( m.timed( grug_timeout.snapshot( self.on_light )), light )    # relay state change from wired button
+
+        # if light is on at app start, remember to turn it off, unless an expired timer will,
+        # or the timers were handed over by the previous instance of the app
+        if grug_state.track( api, self.light ) == "on" and not handed_over and not self.expired_on_restart():
+            self.timer.set( self.args["button_delay"] )
+
+    def initialize( self ):
+        pass
+
+    "Call after hand_off(). The app is torn down once for all rooms, see unregister()"
+    def terminate(self):
+        self.timer.cancel()
+    
+    """
+        Take the state handed over by the previous instance of the app, see
+        grug_handoff, or load the timers from persistence. True if handed over.
+    """
+    def resume( self ):
+        state = grug_handoff.take( self.name )
+        if state is None:
+            self.state = self.MACHINE.initial   # remember if it was us who set the light
+            self.load()
+            return False
+        self.state = state.get( "state", self.MACHINE.initial )
+        self.timer.take_over( state["timer"] )
+        self.timeout.take_over( state["timeout"] )
+        return True
+
+    def hand_off( self ):
+        grug_handoff.put( self.name, {
+            "state":    self.state,
+            "timer":    self.timer.hand_off(),
+            "timeout":  self.timeout.hand_off(),
+        } )
+
+    """
+        One record for both timers: an event changing both of them is one
+        write, see grug_persist.Writer.
+    """
+    def save( self ):
+        if self.loading:
+            return
+        timer, timeout = self.timer.pack(), self.timeout.pack()
+        state = "on" if timer["on"] or timeout["on"] else "off"
+        self._save( state, { "v":self.SCHEMA, "timer":timer, "timeout":timeout } )
+
+    #   unpack() may queue the callback if the timer expired, so both timers
+    #   have to be initialized before calling load()
+    def load( self ):
+        state, attrs = self._load()
+        if state is None:
+            attrs = self.migrate()
+            if attrs is None:
+                self.timer.reset()
+                self.timeout.reset()
+                return
+        elif attrs.get( "v" ) != self.SCHEMA:
+            raise ValueError( "Unknown button schema version %r" % attrs.get( "v" ))
+        self.loading = True
+        try:
+            self.timer.unpack( attrs["timer"] )
+            self.timeout.unpack( attrs["timeout"] )
+        finally:
+            self.loading = False
+        if state is None or self.timer.running() or self.timeout.running():
+            self.save()         # in the current schema, with the timers armed again
+
+    """
+        Record of schema 1: each timer in an entity of its own. None if
+        there is none, on first start.
+    """
+    def migrate( self ):
+        record, found = { "v":self.SCHEMA }, False
+        for key in ( "timer", "timeout" ):
+            state, attrs = grug_persist.peek( self.api, self.name+"."+key )
+            if state is None:
+                record[ key ] = { "on":0, "start":None, "expiry":None }
+            else:
+                record[ key ] = dict( grug_timeout.migrate( attrs ), on=int( state == "on" ))
+                found = True
+        return record if found else None
+
+    "True if a timer expired while AppDaemon was down, and will turn the light off soon"
+    def expired_on_restart( self ):
+        return bool( self.timer.restore or self.timeout.restore )
+
+    def fire( self, event, *args ):
+        self.MACHINE.fire( self, event, *args )
+
+    "Turn the light off, on expiry of the timer or the timeout"
+    def light_off( self, reason="" ):
+        if grug_state.get( self.light ) != "off":
+            self.log( "OFF %s", reason )
+        else:
+            self.debug( "OFF %s", reason )
+        self.timeout.reset()
+        grug_command.turn_off( self.api, self.light, priority=grug_command.FADE )
+
+    "Turn the light on. Logs after the command is sent."
+    def light_on( self, reason="" ):
+        was = grug_state.get( self.light )
+        grug_command.turn_on( self.api, self.light, priority=grug_command.PRESENCE )
+        grug_timeout.after( self.log if was != "on" else self.debug, "ON %s", reason )
+    
+    """Motion sensor state change
+    
+    If the light was turned off by the button, the sensor in front of the
+    button reports occupancy, so it will not send new events until cleared.
+    This allows leaving the room after turning the lights off with the button.
+    
+    But if someone comes from the other end of the corridor and activates another
+    sensor, we want the lights to turn on. So we can't use a composite/group sensor,
+    because that would already be on due to  the person pushing the button.
+
+    Instead we have to check events from each sensor.
+    """
+    def on_sensor( self, entity, old, new ):
+        #   Any sensor state change to "occupancy on" will turn on the lights
+        if new == "on":               # presence detected
+            return self.fire( "sensor_on", entity, old, new )
+
+        self.debug( "on_sensor %s (%s -> %s) sensors on: %s", entity, old, new, self.sensors.count )
+        #   Turn off only when all sensors do not report "on" (ie, "off" or "unavailable")
+        if not self.sensors.occupied():
+            self.fire( "clear" )
+
+    def presence( self, entity, old, new ):
+        self.light_on( "from sensor" )           # command first, timers after
+        grug_timeout.after( self.on_presence, entity, old, new )
+
+    def clear( self ):
+        self.timeout.reset()      # cancel stuck motion detector timeout
+        self.timer.at_least( self.args["motion_delay"] )    # Begin countdown. This will not shorten the timeout set by the button.
+        self.debug( "Timer %ss", self.timer.remaining() )
+
+    "Timer bookkeeping of a presence event, once the light is on"
+    def on_presence( self, entity, old, new ):
+        self.debug( "on_sensor %s (%s -> %s) sensors on: %s", entity, old, new, self.sensors.count )
+        self.timer.cancel()       # stop countdown, this does not clear the expiry time
+        self.timeout.set( self.args["timeout"] )
+
+    """
+    Relay state change, either from zigbee command or pushbutton wired to relay input.
+    """
+    def on_light( self, entity, attribute, old, new, kwargs ):
+        grug_state.update( entity, new )
+        self.fire( LIGHT_EVENTS.get( new, "light_other" ), entity, old, new )
+
+    def manual( self, entity, old, new ):
+        grug_command.override( entity )     # until our next command, see grug_reconcile
+        self.log( "%s: %s -> %s", entity, old, new )
+
+    "Light turned on by button: prolong timeout by button_delay"
+    def button_on( self, entity, old, new ):
+        self.timeout.reset()
+        self.timer.at_least( self.args["button_delay"] )
+
+    "Light turned off by button. Cancel timer and reset expiry time."
+    def button_off( self, entity, old, new ):
+        self.timeout.reset()
+        self.timer.reset()
+
+    def log( self, fmt, *args, level="INFO" ):
+        self.api.log( self.prefix + fmt, *args, level=level )
+
+    "Debug messages go to the trace buffer, see grug_trace"
+    def debug( self, fmt, *args ):
+        self.tracer.trace( fmt, *args )
+
+LIGHT_EVENTS = { "on":"light_on", "off":"light_off" }
+MotionLightButtonActor.MACHINE = grug_machine.Machine( MotionLightButtonActor, MACHINE )
+
+#   Using separate class here, to avoid conflicts between hassapi.Hass
+#   member functions and variable and our own class stuff.
+#
+class MotionLightButton(hassapi.Hass):
+    def initialize(self):
+        self.depends_on_module( grug_timeout )
+        self.__actors = [ MotionLightButtonActor( self, **args ) for args in grug_rooms.configs( self.args ) ]
+        for actor in self.__actors:
+            actor.initialize()
+
+    def terminate(self):
+        for actor in self.__actors:
+            actor.hand_off()        # all rooms first: unregister() drops the restore queue entries of the app
+        for actor in self.__actors:
+            actor.terminate()
+        unregister( self )
+
+"""
+    Teardown shared by all the rooms of an app, after they handed off.
+"""
+def unregister( api ):
+    grug_sensors.unsubscribe( api )
+    grug_metrics.unregister( api )
+    grug_reconcile.unregister( api )
+    grug_trace.unregister( api )
+    grug_timeout.unregister( api )
+    grug_command.unregister( api )
+    grug_persist.flush( api )
+
+"""
+    Same as MotionLightButtonActor, running on the AppDaemon event loop.
+    Event handlers are shared with the sync actor; only setup and teardown,
+    which need to await AppDaemon, are different.
+"""
+class AsyncMotionLightButtonActor( MotionLightButtonActor ):
+    def __init__( self, api, name, sensors, light, **kwargs ):
+        self.api    = api
+        self.name   = name
+        self.prefix = grug_rooms.log_prefix( api.args, name )
+        self.light  = light
+        self.args   = kwargs
+        self.sensor_ids = sensors
+
+    async def initialize( self ):
+        api = self.api
+        await grug_persist.apreload( api )
+        self.metrics = m = grug_metrics.register( api, self.name )
+        self.tracer = grug_trace.register( api, self.name, self.prefix )
+        grug_reconcile.register( api )
+        self.entity_storage_id = self.name + ".storage"
+        self.timer = grug_timeout.AsyncDelayedCallbackF( api, m.timed( lambda: self.fire( "timer", "Timer" )), self.save )
+        self.timeout = grug_timeout.AsyncDelayedCallbackF( api, m.timed( lambda: self.fire( "timeout", "Timeout" )), self.save )
+        handed_over = self.resume()
+        self.log("Timer remaining: %ss Timeout remaining: %ss", self.timer.remaining(), self.timeout.remaining())
+
+        self.sensors = await grug_sensors.asubscribe( api, self.sensor_ids, m.timed( self.on_sensor, latency=True ), self.args.get( "debounce", 0 ))
+        await api.listen_state( grug_timeout.aio( m.timed( grug_timeout.snapshot( self.on_light ))), self.light )
+
+        if await grug_state.atrack( api, self.light ) == "on" and not handed_over and not self.expired_on_restart():
+            self.timer.set( self.args["button_delay"] )
+
+    async def terminate( self ):
+        self.timer.cancel()
+
+class AsyncMotionLightButton(hassapi.Hass):
+    async def initialize(self):
+        self.depends_on_module( grug_timeout )
+        self.__actors = [ AsyncMotionLightButtonActor( self, **args ) for args in grug_rooms.configs( self.args ) ]
+        for actor in self.__actors:
+            await actor.initialize()
+
+    async def terminate(self):
+        for actor in self.__actors:
+            actor.hand_off()
+        for actor in self.__actors:
+            await actor.terminate()
+        await aunregister( self )
+
+"""
+    Same as unregister(), for async apps.
+"""
+async def aunregister( api ):
+    await grug_sensors.aunsubscribe( api )
+    grug_metrics.unregister( api )
+    grug_reconcile.unregister( api )
+    grug_trace.unregister( api )
+    grug_timeout.unregister( api )
+    grug_command.unregister( api )
+    await grug_persist.aflush( api )
+
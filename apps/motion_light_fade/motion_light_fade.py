@@ -1,123 +1,358 @@
-import appdaemon.plugins.hass.hassapi as hassapi
-import time, importlib
-
-import grug_timeout, grug_persist
-# importlib.reload( shared.timeout )
-
-"""
-    Motion activated light with fade out
-
-    sensors:        A list of motion sensors, as HA entities.
-    light:          Light entity to control.
-
-    set log_level DEBUG in this app's yaml config for logging.
-"""
-class MotionLightFadeActor( grug_persist.PersistMixin ):
-    def __init__( self, api, args ):
-        self.api    = api
-        self.name   = args[ "name" ]
-        self.light  = args[ "light" ]
-        self.fade_list = args[ "fade" ]
-        self.step = len(self.fade_list)-1
-        self.timer = grug_timeout.DelayedCallback( api, self.light_off, self.name+".timer" )
-
-        self.sensor_state = {}
-        self.sensors = args["sensors"]
-        for sensor in self.sensors:
-            api.listen_state( self.on_sensor, sensor )  # motion detector
-
-        # Load first, it will set timer to default value
-        self.entity_storage_id   = self.name + ".storage"
-        self.load()
-        self.api.log( "Timer remaining: %ss step:%s", self.timer.remaining(), self.step )
-
-        # ... then load the saved timer expiration
-        self.timer.load()
-
-    def initialize( self ):
-        pass
-
-    def terminate( self ):
-        self.timer.cancel()
-
-    def reset( self ):
-        self.timer.cancel()
-        self.api.turn_off( self.light )
-
-    def do_fade( self, step ):
-        fade = self.fade_list[step]
-        if fade["brightness"]:
-            self.debug("fade: %s", fade)
-            self.api.turn_on( self.light, brightness=fade["brightness"], transition=fade["fade_time"] )
-        else:
-            self.api.log("OFF")
-            self.api.turn_off( self.light )
-        self.step = step
-        self.save()
-
-    "Turn the light on"
-    def light_on( self, step=0, start_timer=True, reason="" ):
-        if self.api.get_state( self.light ) != "on":
-            self.api.log( "ON %s", reason )
-        self.debug( "light_on %s", start_timer )
-        step = min(max(0,step), len(self.fade_list)-1)
-        self.fade_iter = iter(range( step+1, len( self.fade_list )))
-        if start_timer:
-            self.timer.set( self.fade_list[step]["wait_time"] )
-        self.do_fade( step )
-
-    "Proceed to the list of brightness and wait times"
-    def light_off( self ):
-        for step in self.fade_iter:
-            self.debug( "Fade step %d", step )
-            self.timer.set( self.fade_list[step]["wait_time"] )
-            self.do_fade( step )
-            return
-
-    """Motion sensor state change
-    """
-    def on_sensor( self, entity, attribute, old, new, kwargs ):
-        #   Any sensor state change to "occupancy on" will turn on the lights
-        old_states = [ self.sensor_state.get(id) for id in self.sensors ]
-        self.sensor_state[ entity ] = new
-        new_states = [ self.sensor_state.get(id) for id in self.sensors ]
-        self.debug( "on_sensor %s (%s -> %s) states %s -> %s", entity, old, new, old_states, new_states )
-      
-        #   Any sensor state change to "occupancy on" will turn on the lights
-        if new == "on":
-            self.timer.reset()  # stay on as long as motion is detected
-            self.light_on( start_timer=False, reason="from sensor" )
-        #   Turn off only when all sensors do not report "on" (ie, "off" or "unavailable")
-        elif "on" not in new_states:
-            self.light_on( )
-
-    def debug( self, fmt, *args ):
-        self.api.log( fmt, *args, level="DEBUG" )
-
-    def save( self ):
-        state = "on" if self.step < len(self.fade_list)-1 else "off"
-        attrs = { k:getattr( self, k ) for k in ("step", ) }
-        self._save( state, attrs )
-
-    def load( self ):
-        state, attrs = self._load()
-        if state in (None, "off"):
-            return self.reset()
-        else:
-            step = attrs["step"]
-            if state == "on":
-                self.light_on( step, reason="from load" )
-
-#   Using separate class here, to avoid conflicts between hassapi.Hass
-#   member functions and variable and our own class stuff.
-#
-class MotionLightFade(hassapi.Hass):
-    def initialize(self):
-        self.depends_on_module( grug_timeout )
-        self.__actor = MotionLightFadeActor( self, self.args )
-        self.__actor.initialize()
-
-    def cancel(self):
-        self.__actor.terminate()
-
-
+import appdaemon.plugins.hass.hassapi as hassapi
+import time, importlib, bisect, itertools
+
+import grug_timeout, grug_persist, grug_state, grug_command, grug_sensors, grug_metrics, grug_rooms, grug_handoff, grug_reconcile, grug_trace, grug_machine
+# importlib.reload( shared.timeout )
+
+"""
+    Motion activated light with fade out
+
+    sensors:        A list of motion sensors, as HA entities.
+    light:          Light entity to control, or a list of them sharing the
+                    fade. Each step is then a single command for all of them.
+    group:          Optional group entity standing for the lights (a Home
+                    Assistant light group, or a zigbee2mqtt group listed in
+                    mqtt_outputs), sent the commands instead of the list.
+    debounce:       Optional debounce window for flapping sensors, in seconds
+                    or as { sensor: seconds }, see grug_sensors.
+    rooms:          Optional list of rooms hosted by this app, each with
+                    the keys above, see grug_rooms.
+
+    set log_level DEBUG in this app's yaml config for logging. Debug messages
+    are also kept in memory and can be dumped, see grug_trace.
+"""
+"""
+    Fade profile compiled from the "fade" list of the yaml config.
+    offsets[i] is the time from the start of the fade to step i, so the
+    step at any time is found by bisection. Rooms with the same fade list
+    (usually a yaml anchor) share one profile.
+"""
+class FadeProfile:
+    def __init__( self, fade_list ):
+        self.steps   = fade_list
+        self.last    = len( fade_list )-1
+        self.offsets = list( itertools.accumulate( [0] + [ f["wait_time"] for f in fade_list[:-1] ] ))
+
+    def step_at( self, elapsed ):
+        return max( 0, bisect.bisect_right( self.offsets, elapsed )-1 )
+
+_profiles = {}
+
+def get_profile( fade_list ):
+    key = tuple( tuple( sorted( f.items() )) for f in fade_list )
+    profile = _profiles.get( key )
+    if profile is None:
+        profile = _profiles[ key ] = FadeProfile( fade_list )
+    return profile
+
+"""
+    held while motion is detected, fading once all sensors are clear, dark
+    after the last step. The step and its timer follow from fade_start.
+"""
+MACHINE = """
+states:  [ held, fading, dark ]
+initial: dark
+transitions:
+  - { from: "*", event: sensor_on, do: [ hold ], to: held }
+  - { from: "*", event: clear, do: [ fade ], to: fading }
+  - { from: "*", event: step, do: [ light_off ] }
+  - { from: "*", event: faded, to: dark }
+"""
+
+class MotionLightFadeActor( grug_persist.PersistMixin ):
+    """
+        Persisted record, by schema version "v":
+        1   { "step": n }, the timer in a ".timer" entity of its own
+        2   { "step": n } and the timer, in the schema of grug_timeout
+        3   { "start": epoch }, start of the fade, None while held on by motion
+    """
+    SCHEMA = 3
+
+    def __init__( self, api, args ):
+        self.api    = api
+        self.name   = args[ "name" ]
+        self.prefix = grug_rooms.log_prefix( api.args, self.name )
+        self.lights = grug_command.entity_list( args[ "light" ] )
+        self.group  = args.get( "group" )
+        self.fade_list = args[ "fade" ]
+        self.profile = get_profile( self.fade_list )
+        self.step = self.profile.last
+        self.fade_start = None      # clock() time the fade started, None while held on by motion
+        self.state = self.MACHINE.initial
+        self.metrics = m = grug_metrics.register( api, self.name )
+        self.tracer = grug_trace.register( api, self.name, self.prefix )
+        grug_reconcile.register( api )
+        self.entity_storage_id = self.name + ".storage"
+        self.timer = grug_timeout.DelayedCallbackF( api, m.timed( lambda: self.fire( "step" )))     # next step of the fade
+
+        self.sensors = grug_sensors.subscribe( api, args["sensors"], m.timed( self.on_sensor, latency=True ), args.get( "debounce", 0 ))    # motion detectors
+        on_light = m.timed( grug_timeout.snapshot( self.on_light ))
+        for light in self.lights:
+            api.listen_state( on_light, light )     # keep grug_state mirror current
+            grug_state.track( api, light )
+
+        self.resume()
+        self.log( "Timer remaining: %ss step:%s", self.timer.remaining(), self.step )
+
+    def initialize( self ):
+        pass
+
+    "Call after hand_off(). The app is torn down once for all rooms, see unregister()"
+    def terminate( self ):
+        self.timer.cancel()
+
+    def reset( self ):
+        self.timer.cancel()
+        grug_command.turn_off( self.api, self.lights, group=self.group )
+
+    def do_fade( self, step, priority=grug_command.FADE ):
+        fade = self.fade_list[step]
+        if fade["brightness"]:
+            grug_command.turn_on( self.api, self.lights, group=self.group, priority=priority, brightness=fade["brightness"], transition=fade["fade_time"] )
+            self.debug("fade: %s", fade)
+        else:
+            grug_command.turn_off( self.api, self.lights, group=self.group, priority=priority )
+            self.log("OFF")
+        self.step = step
+
+    """
+        Go to the step of the fade at the current time, and schedule the
+        next one. Held on by motion, that is step 0 without timer.
+        The command is sent before the timer is touched.
+    """
+    def fade_to( self, priority=grug_command.FADE ):
+        p = self.profile
+        if self.fade_start is None:
+            step = 0
+        else:
+            # the timer wheel may fire a bit early
+            step = p.step_at( grug_timeout.now() - self.fade_start + grug_timeout.TimerWheel.EARLY )
+        self.do_fade( step, priority )
+        if self.fade_start is not None and step < p.last:
+            self.timer.expire_at( self.fade_start + p.offsets[step+1] )
+        else:
+            self.timer.cancel()
+
+    "Turn the light on, and fade out from fade_start, or stay on while it is None"
+    #   Logging and saving run after the callback, see grug_timeout.after()
+    def light_on( self, fade_start, reason="", priority=grug_command.FADE ):
+        was = "on" if any( grug_state.get( light ) == "on" for light in self.lights ) else None
+        self.fade_start = fade_start
+        self.fade_to( priority )
+        grug_timeout.after( self.log_on, was, reason )
+        grug_timeout.after( self.save )
+
+    def log_on( self, was, reason ):
+        if was != "on":
+            self.log( "ON %s", reason )
+        self.debug( "light_on %s", self.fade_start )
+
+    "Proceed to the next step of the fade"
+    def light_off( self ):
+        self.debug( "Fade step %d", self.step+1 )
+        self.fade_to()
+        if self.step == self.profile.last:
+            self.save()
+            self.fire( "faded" )
+
+    def fire( self, event, *args ):
+        self.MACHINE.fire( self, event, *args )
+
+    "Machine state following from the fade, after loading it"
+    def settle( self ):
+        if self.step == self.profile.last:
+            return "dark"
+        return "held" if self.fade_start is None else "fading"
+
+    """Motion sensor state change
+    """
+    def on_sensor( self, entity, old, new ):
+        #   Any sensor state change to "occupancy on" will turn on the lights
+        if new == "on":
+            return self.fire( "sensor_on", entity, old, new )
+
+        self.debug( "on_sensor %s (%s -> %s) sensors on: %s", entity, old, new, self.sensors.count )
+        #   Turn off only when all sensors do not report "on" (ie, "off" or "unavailable")
+        if not self.sensors.occupied():
+            self.fire( "clear" )
+
+    def hold( self, entity, old, new ):
+        self.light_on( None, reason="from sensor", priority=grug_command.PRESENCE )     # stay on as long as motion is detected
+        grug_timeout.after( self.debug, "on_sensor %s (%s -> %s) sensors on: %s", entity, old, new, self.sensors.count )
+
+    def fade( self ):
+        self.light_on( grug_timeout.now() )
+
+    def on_light( self, entity, attribute, old, new, kwargs ):
+        grug_state.update( entity, new )
+        if new in ( "on", "off" ) and new != grug_command.commanded( entity ):
+            grug_command.override( entity )     # changed by hand, see grug_reconcile
+
+    def log( self, fmt, *args, level="INFO" ):
+        self.api.log( self.prefix + fmt, *args, level=level )
+
+    "Debug messages go to the trace buffer, see grug_trace"
+    def debug( self, fmt, *args ):
+        self.tracer.trace( fmt, *args )
+
+    """
+        One small record per room: when the fade started. The step and the
+        timer follow from it.
+    """
+    def save( self ):
+        state = "on" if self.step < self.profile.last else "off"
+        self._save( state, { "v":self.SCHEMA, "start":grug_timeout.to_epoch( self.fade_start ) } )
+
+    """
+        Take the fade handed over by the previous instance of the app, see
+        grug_handoff, or load it from persistence. The light is left as it
+        is, only the timer of the next step is armed again.
+    """
+    def resume( self ):
+        state = grug_handoff.take( self.name )
+        if state is None or state["fade"] != self.fade_list:
+            self.load()
+        else:
+            self.fade_start = state["fade_start"]
+            self.step       = state["step"]
+            self.timer.take_over( state["timer"] )
+        self.state = self.settle()
+
+    def hand_off( self ):
+        grug_handoff.put( self.name, {
+            "fade":         self.fade_list,
+            "fade_start":   self.fade_start,
+            "step":         self.step,
+            "timer":        self.timer.hand_off(),
+        } )
+
+    def load( self ):
+        state, attrs = self._load()
+        if state in (None, "off"):
+            return self.reset()
+        start = self.migrate( attrs )["start"]
+        if start is None:
+            # held on by motion: it may have cleared while AppDaemon was down, with no event to come
+            return self.light_on( grug_timeout.now(), reason="from load" )
+        end = start + self.profile.offsets[-1]
+        if grug_timeout.from_epoch( end ) <= grug_timeout.now():
+            # the fade ended while AppDaemon was down: catch up with the other expired timers
+            self.fade_start = grug_timeout.from_epoch( start )
+            self.timer.unpack( { "on":1, "start":start, "expiry":end } )
+        else:
+            self.light_on( grug_timeout.from_epoch( start ), reason="from load" )
+
+    def migrate( self, attrs ):
+        version = attrs.get( "v", 1 )
+        if version == self.SCHEMA:
+            return attrs
+        if version == 1:
+            state, timer = grug_persist.peek( self.api, self.name+".timer" )
+            timer = grug_timeout.migrate( timer ) if timer else { "start":None, "expiry":None }
+            attrs = dict( timer, v=2, step=attrs["step"], on=int( state == "on" ))
+        if attrs["v"] == 2:
+            p, step = self.profile, min( attrs["step"], self.profile.last )
+            if attrs["on"] and attrs["expiry"] is not None and step < p.last:
+                start = attrs["expiry"] - p.offsets[step+1]
+            else:
+                start = grug_timeout.to_epoch( grug_timeout.now() ) - p.offsets[step]
+            return { "v":self.SCHEMA, "start":start }
+        raise ValueError( "Unknown fade schema version %r" % version )
+
+MotionLightFadeActor.MACHINE = grug_machine.Machine( MotionLightFadeActor, MACHINE )
+
+#   Using separate class here, to avoid conflicts between hassapi.Hass
+#   member functions and variable and our own class stuff.
+#
+class MotionLightFade(hassapi.Hass):
+    def initialize(self):
+        self.depends_on_module( grug_timeout )
+        self.__actors = [ MotionLightFadeActor( self, args ) for args in grug_rooms.configs( self.args ) ]
+        for actor in self.__actors:
+            actor.initialize()
+
+    def terminate(self):
+        for actor in self.__actors:
+            actor.hand_off()        # all rooms first: unregister() drops the restore queue entries of the app
+        for actor in self.__actors:
+            actor.terminate()
+        unregister( self )
+
+"""
+    Teardown shared by all the rooms of an app, after they handed off.
+"""
+def unregister( api ):
+    grug_sensors.unsubscribe( api )
+    grug_metrics.unregister( api )
+    grug_reconcile.unregister( api )
+    grug_trace.unregister( api )
+    grug_timeout.unregister( api )
+    grug_command.unregister( api )
+    grug_persist.flush( api )
+
+"""
+    Same as MotionLightFadeActor, running on the AppDaemon event loop.
+    Event handlers are shared with the sync actor; only setup and teardown,
+    which need to await AppDaemon, are different.
+"""
+class AsyncMotionLightFadeActor( MotionLightFadeActor ):
+    def __init__( self, api, args ):
+        self.api    = api
+        self.args   = args
+        self.name   = args[ "name" ]
+        self.prefix = grug_rooms.log_prefix( api.args, self.name )
+        self.lights = grug_command.entity_list( args[ "light" ] )
+        self.group  = args.get( "group" )
+        self.fade_list = args[ "fade" ]
+        self.profile = get_profile( self.fade_list )
+        self.step = self.profile.last
+        self.fade_start = None
+        self.state = self.MACHINE.initial
+
+    async def initialize( self ):
+        api = self.api
+        await grug_persist.apreload( api )
+        self.metrics = m = grug_metrics.register( api, self.name )
+        self.tracer = grug_trace.register( api, self.name, self.prefix )
+        grug_reconcile.register( api )
+        self.entity_storage_id = self.name + ".storage"
+        self.timer = grug_timeout.AsyncDelayedCallbackF( api, m.timed( lambda: self.fire( "step" )))
+
+        self.sensors = await grug_sensors.asubscribe( api, self.args["sensors"], m.timed( self.on_sensor, latency=True ), self.args.get( "debounce", 0 ))
+        on_light = grug_timeout.aio( m.timed( grug_timeout.snapshot( self.on_light )))
+        for light in self.lights:
+            await api.listen_state( on_light, light )
+            await grug_state.atrack( api, light )
+
+        self.resume()
+        self.log( "Timer remaining: %ss step:%s", self.timer.remaining(), self.step )
+
+    async def terminate( self ):
+        self.timer.cancel()
+
+class AsyncMotionLightFade(hassapi.Hass):
+    async def initialize(self):
+        self.depends_on_module( grug_timeout )
+        self.__actors = [ AsyncMotionLightFadeActor( self, args ) for args in grug_rooms.configs( self.args ) ]
+        for actor in self.__actors:
+            await actor.initialize()
+
+    async def terminate(self):
+        for actor in self.__actors:
+            actor.hand_off()
+        for actor in self.__actors:
+            await actor.terminate()
+        await aunregister( self )
+
+"""
+    Same as unregister(), for async apps.
+"""
+async def aunregister( api ):
+    await grug_sensors.aunsubscribe( api )
+    grug_metrics.unregister( api )
+    grug_reconcile.unregister( api )
+    grug_trace.unregister( api )
+    grug_timeout.unregister( api )
+    grug_command.unregister( api )
+    await grug_persist.aflush( api )
+
@@ -1,87 +1,274 @@
-import appdaemon.plugins.hass.hassapi as hassapi
-import time, importlib
-import grug_timeout #, grug_gmqtt
-# importlib.reload( shared.timeout )
-
-"""
-    Multi-button scene controller -> one timer per button -> switch
-"""
-class MultiTimerActor:
-    def __init__( self, api ):
-        self.api  = api
-        self.args = api.args
-        self.name = self.args["name"]
-        self.trigger_topics = api.args["trigger_topics"]
-        self.output_switch  = api.args["output_switch"]
-        self.output_state_we_set = None
-        self.debug("Output: %s Triggers: %s", self.output_switch, self.trigger_topics)
-
-        self.api.listen_state( self.on_output_changed, self.output_switch )
-        self.timer = grug_timeout.DelayedCallback( api, self.timer_callback, self.name+".timer" )
-        self.timer.load()
-        self.api.log("Timer remaining: %s s", self.timer.remaining())
-
-    def debug( self, fmt, *args ):
-        self.api.log( fmt, *args, level="DEBUG" )
-
-    def terminate(self):
-        self.api.log('#### terminate')
-        self.timer.cancel()
-
-    def initialize( self ):
-        self.mqtt = self.api.get_plugin_api("MQTT")
-        for topic in self.trigger_topics:
-            self.mqtt.listen_event(self.mqtt_message_received_event, "MQTT_MESSAGE", topic=topic )
-        if not self.mqtt.is_client_connected():
-            self.api.log('### MQTT is not connected')
-
-    def mqtt_message_received_event( self, eventname, data, kwargs ):
-        # self.api.log( "%s", { "eventname":eventname, "data":data, "kwargs":kwargs } )
-        topic = data["topic"]
-        payload = data["payload"]
-        if not (trigger_actions := self.trigger_topics.get( topic )):
-            return self.api.log( "Topic %r is not configured.", topic )
-        if not (action := trigger_actions.get( payload )):
-            return self.api.log( "Topic %r Payload %r is not configured.", topic, payload )
-        if state := action.get("state"):
-            self.timer.reset()
-            if state == "off":
-                self.output_state_we_set = "off"
-                self.api.log( "OFF by button" )
-                self.api.turn_off( self.output_switch )
-            elif state == "on":
-                self.output_state_we_set = "on"
-                self.api.log( "ON by button" )
-                self.api.turn_on( self.output_switch )
-        elif on_time := action.get( "on_time" ):
-            self.output_state_we_set = "on"
-            self.api.turn_on( self.output_switch )
-            self.api.log( "ON for %ss", on_time )
-            self.timer.set( on_time )
-
-    def timer_callback( self ):
-        self.api.turn_off( self.output_switch )
-
-    def on_output_changed( self, entity, attribute, old, new, kwargs ):
-        if new == self.output_state_we_set:
-            # We caused this state change, ignore it.
-            return
-        
-        # Manual control: cancel timer
-        self.output_state_we_set = None
-        self.api.log( "%s: %s -> %s", entity, old, new )
-        self.timer.reset()
-
-#   Using separate class here, to avoid conflicts between hassapi.Hass
-#   member functions and variable and our own class stuff.
-#
-class MultiTimer(hassapi.Hass):
-    def initialize(self):
-        self.depends_on_module( grug_timeout )
-        self.__actor = MultiTimerActor( self )
-        self.__actor.initialize()
-
-    def terminate(self):
-        self.__actor.terminate()
-
-
+import appdaemon.plugins.hass.hassapi as hassapi
+import time, importlib
+import grug_timeout, grug_persist, grug_state, grug_command, grug_metrics, grug_handoff, grug_reconcile, grug_trace, grug_machine #, grug_gmqtt
+# importlib.reload( shared.timeout )
+
+"""
+    Multi-button scene controller -> one timer per button -> switch
+
+    trigger_topics keys are MQTT topics, which may contain the wildcards
+    "+" and "#" (like "z2m/+/action") to serve many buttons with a single
+    subscription. When several patterns match a topic, the most specific
+    one wins: exact level, then "+", then "#". Messages delivered by the
+    subscriptions of the other matching patterns are ignored.
+
+    output_switch may be a list of entities sharing the timer, switched
+    with a single command. With "group", a group entity standing for them
+    (see grug_command) is sent the commands instead.
+"""
+
+"""
+    Trie of MQTT topic patterns, split on "/".
+"""
+class TopicTrie:
+    def __init__( self ):
+        self.children = {}
+        self.value = None
+
+    def insert( self, pattern, value ):
+        node = self
+        for level in pattern.split( "/" ):
+            node = node.children.setdefault( level, TopicTrie() )
+        node.value = value
+
+    def match( self, topic ):
+        return self._match( topic.split( "/" ), 0 )
+
+    def _match( self, levels, i ):
+        if i == len( levels ):
+            return self.value
+        for key in ( levels[i], "+" ):
+            if (child := self.children.get( key )) and (value := child._match( levels, i+1 )) is not None:
+                return value
+        if child := self.children.get( "#" ):
+            return child.value
+        return None
+
+"""
+    One configured button action, compiled from its yaml dict into the
+    event it fires.
+"""
+class Action:
+    def __init__( self, conf ):
+        self.state   = conf.get( "state" )
+        self.on_time = conf.get( "on_time" )
+        if self.state:
+            self.event = { "off":"button_off", "on":"button_on" }.get( self.state, "button_other" )
+        else:
+            self.event = "button_timed" if self.on_time else None
+
+    def __call__( self, actor ):
+        if self.event:
+            actor.fire( self.event, self )
+
+"""
+    The state is who set the output last: "on" or "off" by us, so the state
+    change that follows is only the echo of our command, or "manual".
+"""
+MACHINE = """
+states:  [ "on", "off", manual ]
+initial: manual
+transitions:
+  - { from: "*", event: button_off, do: [ stop_timer, switch_off ], to: "off" }
+  - { from: "*", event: button_on, do: [ stop_timer, switch_on ], to: "on" }
+  - { from: "*", event: button_other, do: [ stop_timer ] }
+  - { from: "*", event: button_timed, do: [ switch_on_for ], to: "on" }
+  # the state stays: the echo cancels the timer like a manual change
+  - { from: "*", event: timer, do: [ timer_callback ] }
+  # echoes of our own commands
+  - { from: "on",  event: output_on }
+  - { from: "off", event: output_off }
+  # manual control: cancel timer
+  - { from: "*", event: [ output_on, output_off, output_other ], do: [ manual ], to: manual }
+"""
+OUTPUT_EVENTS = { "on":"output_on", "off":"output_off" }
+
+class MultiTimerActor:
+    def __init__( self, api ):
+        self.api  = api
+        self.args = api.args
+        self.name = self.args["name"]
+        self.trigger_topics = api.args["trigger_topics"]
+        self.outputs = grug_command.entity_list( api.args["output_switch"] )
+        self.group   = api.args.get( "group" )
+        self.state = self.MACHINE.initial
+        self.tracer = grug_trace.register( api, self.name )
+        self.debug("Output: %s Triggers: %s", self.outputs, self.trigger_topics)
+
+        self.compile_triggers()
+
+        self.metrics = m = grug_metrics.register( api, self.name )
+        grug_reconcile.register( api )
+        on_output_changed = m.timed( grug_timeout.snapshot( self.on_output_changed ))
+        for output in self.outputs:
+            self.api.listen_state( on_output_changed, output )
+            grug_state.track( api, output )
+        self.timer = grug_timeout.DelayedCallback( api, m.timed( lambda: self.fire( "timer" )), self.name+".timer" )
+        self.resume()
+        self.api.log("Timer remaining: %s s", self.timer.remaining())
+
+    def compile_triggers( self ):
+        # topic pattern -> ( pattern, { payload: Action } )
+        self.trie = TopicTrie()
+        for pattern, actions in self.trigger_topics.items():
+            self.trie.insert( pattern, ( pattern, { payload:Action( conf ) for payload, conf in actions.items() } ))
+        self.routes = {}    # topic -> ( pattern, { payload: Action } ), memo of trie lookups
+
+    "Debug messages go to the trace buffer, see grug_trace"
+    def debug( self, fmt, *args ):
+        self.tracer.trace( fmt, *args )
+
+    """
+        Take the state handed over by the previous instance of the app, see
+        grug_handoff, or load the timer from persistence.
+    """
+    def resume( self ):
+        state = grug_handoff.take( self.name )
+        if state is None:
+            return self.timer.load()
+        self.state = state.get( "state", self.MACHINE.initial )
+        self.timer.take_over( state["timer"] )
+
+    def hand_off( self ):
+        grug_handoff.put( self.name, { "state":self.state, "timer":self.timer.hand_off() } )
+
+    def terminate(self):
+        self.teardown()
+        grug_persist.flush( self.api )
+
+    """
+        Everything terminate() does, but the final flush.
+    """
+    def teardown( self ):
+        self.api.log('#### terminate')
+        self.hand_off()
+        grug_metrics.unregister( self.api )
+        grug_reconcile.unregister( self.api )
+        grug_trace.unregister( self.api )
+        grug_timeout.unregister( self.api )
+        grug_command.unregister( self.api )
+        self.timer.cancel()
+
+    def initialize( self ):
+        self.mqtt = self.api.get_plugin_api("MQTT")
+        callback = self.metrics.timed( grug_timeout.snapshot( self.mqtt_message_received_event ), latency=True )
+        for pattern in self.trigger_topics:
+            if "+" in pattern or "#" in pattern:
+                self.mqtt.listen_event(callback, "MQTT_MESSAGE", wildcard=pattern )
+            else:
+                self.mqtt.listen_event(callback, "MQTT_MESSAGE", topic=pattern )
+        if not self.mqtt.is_client_connected():
+            self.api.log('### MQTT is not connected')
+
+    def mqtt_message_received_event( self, eventname, data, kwargs ):
+        # self.api.log( "%s", { "eventname":eventname, "data":data, "kwargs":kwargs } )
+        topic = data["topic"]
+        payload = data["payload"]
+        if (route := self.routes.get( topic )) is None:
+            route = self.routes[ topic ] = self.trie.match( topic ) or ( None, {} )
+        pattern, actions = route
+        if pattern != kwargs.get( "wildcard", kwargs.get( "topic" )):
+            return      # also delivered to the subscription of the most specific pattern
+        if not (action := actions.get( payload )):
+            return self.debug( "Topic %r Payload %r is not configured.", topic, payload )
+        action( self )
+
+    def fire( self, event, *args ):
+        self.MACHINE.fire( self, event, *args )
+
+    def stop_timer( self, action ):
+        self.timer.reset()
+
+    def switch_off( self, action ):
+        self.api.log( "OFF by button" )
+        grug_command.turn_off( self.api, self.outputs, group=self.group )
+
+    def switch_on( self, action ):
+        self.api.log( "ON by button" )
+        grug_command.turn_on( self.api, self.outputs, group=self.group )
+
+    def switch_on_for( self, action ):
+        grug_command.turn_on( self.api, self.outputs, group=self.group )
+        self.api.log( "ON for %ss", action.on_time )
+        self.timer.set( action.on_time )
+
+    def timer_callback( self ):
+        grug_command.turn_off( self.api, self.outputs, group=self.group )
+
+    def on_output_changed( self, entity, attribute, old, new, kwargs ):
+        grug_state.update( entity, new )
+        self.fire( OUTPUT_EVENTS.get( new, "output_other" ), entity, old, new )
+
+    def manual( self, entity, old, new ):
+        grug_command.override( entity )
+        self.api.log( "%s: %s -> %s", entity, old, new )
+        self.timer.reset()
+
+MultiTimerActor.MACHINE = grug_machine.Machine( MultiTimerActor, MACHINE )
+
+#   Using separate class here, to avoid conflicts between hassapi.Hass
+#   member functions and variable and our own class stuff.
+#
+class MultiTimer(hassapi.Hass):
+    def initialize(self):
+        self.depends_on_module( grug_timeout )
+        self.__actor = MultiTimerActor( self )
+        self.__actor.initialize()
+
+    def terminate(self):
+        self.__actor.terminate()
+
+"""
+    Same as MultiTimerActor, running on the AppDaemon event loop.
+    Event handlers are shared with the sync actor; only setup, which needs
+    to await AppDaemon, is different.
+"""
+class AsyncMultiTimerActor( MultiTimerActor ):
+    def __init__( self, api ):
+        self.api = api
+
+    async def initialize( self ):
+        api = self.api
+        await grug_persist.apreload( api )
+        self.args = api.args
+        self.name = self.args["name"]
+        self.trigger_topics = api.args["trigger_topics"]
+        self.outputs = grug_command.entity_list( api.args["output_switch"] )
+        self.group   = api.args.get( "group" )
+        self.state = self.MACHINE.initial
+        self.compile_triggers()
+
+        self.metrics = m = grug_metrics.register( api, self.name )
+        self.tracer = grug_trace.register( api, self.name )
+        grug_reconcile.register( api )
+        on_output_changed = grug_timeout.aio( m.timed( grug_timeout.snapshot( self.on_output_changed )))
+        for output in self.outputs:
+            await api.listen_state( on_output_changed, output )
+            await grug_state.atrack( api, output )
+        self.timer = grug_timeout.AsyncDelayedCallback( api, m.timed( lambda: self.fire( "timer" )), self.name+".timer" )
+        self.resume()
+        self.api.log("Timer remaining: %s s", self.timer.remaining())
+
+        self.mqtt = api.get_plugin_api("MQTT")
+        callback = grug_timeout.aio( m.timed( grug_timeout.snapshot( self.mqtt_message_received_event ), latency=True ))
+        for pattern in self.trigger_topics:
+            if "+" in pattern or "#" in pattern:
+                await self.mqtt.listen_event( callback, "MQTT_MESSAGE", wildcard=pattern )
+            else:
+                await self.mqtt.listen_event( callback, "MQTT_MESSAGE", topic=pattern )
+        if not await self.mqtt.is_client_connected():
+            self.api.log('### MQTT is not connected')
+
+    async def terminate( self ):
+        self.teardown()
+        await grug_persist.aflush( self.api )
+
+class AsyncMultiTimer(hassapi.Hass):
+    async def initialize(self):
+        self.depends_on_module( grug_timeout )
+        self.__actor = AsyncMultiTimerActor( self )
+        await self.__actor.initialize()
+
+    async def terminate(self):
+        await self.__actor.terminate()
+
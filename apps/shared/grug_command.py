@@ -0,0 +1,419 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import time, heapq, itertools, asyncio, threading, json, weakref
+
+import grug_state, grug_metrics
+
+"""
+    Output commands shared by all apps.
+
+    Remembers the last command sent to each entity (state and attributes)
+    and drops a new command that is identical to it, as long as the state
+    mirrored by grug_state agrees with what we commanded. If the entity was
+    changed by someone else, or its state is unknown, the command goes out.
+
+    Transition time is not part of the comparison: sending the same
+    brightness again with another transition does not change anything.
+
+    Pass force=True to always send.
+
+    entity_id may also be a list of entities sharing the command, like the
+    bulbs of a room: see _command_many().
+
+    Commands that are not dropped go through the Mesh scheduler of the app,
+    see below. priority is one of PRESENCE, BUTTON, FADE. They are sent as
+    service calls, or over MQTT, see _send().
+"""
+_last = {}      # entity_id -> ( state, attrs )
+_owner = {}     # entity_id -> ( api, clock() time ) of the last command sent
+_overridden = set()     # entities changed by someone else since our last command
+_groups = {}    # group entity_id -> its members, as last commanded
+_local = threading.local()
+
+IGNORED_ATTRS = ( "transition", )
+
+#   Command priorities, lowest first
+PRESENCE = 0    # light on for motion: someone is waiting in the dark
+BUTTON   = 1    # button presses, manual control
+FADE     = 2    # fade steps and timer driven changes
+
+clock = time.monotonic
+
+def _key( state, kwargs ):
+    return state, { k:v for k,v in kwargs.items() if k not in IGNORED_ATTRS }
+
+def _redundant( entity_id, cmd ):
+    return _last.get( entity_id ) == cmd and grug_state.get( entity_id ) == cmd[0]
+
+"""
+    Turn entity on, unless it is already on because of an identical command.
+    Returns True if the command was sent or queued.
+"""
+def turn_on( api, entity_id, force=False, priority=BUTTON, group=None, **kwargs ):
+    if not isinstance( entity_id, str ):
+        return _command_many( api, "on", entity_id, group, force, priority, kwargs )
+    return _command( api, "on", entity_id, force, priority, kwargs )
+
+"""
+    Turn entity off, unless it is already off because of our last command.
+    Returns True if the command was sent or queued.
+"""
+def turn_off( api, entity_id, force=False, priority=BUTTON, group=None, **kwargs ):
+    if not isinstance( entity_id, str ):
+        return _command_many( api, "off", entity_id, group, force, priority, kwargs )
+    return _command( api, "off", entity_id, force, priority, kwargs )
+
+def _command( api, state, entity_id, force, priority, kwargs ):
+    cmd = _key( state, kwargs )
+    sent = force or not _redundant( entity_id, cmd )
+    metrics = grug_metrics.current()
+    if sent:
+        _last[ entity_id ] = cmd
+        _owner[ entity_id ] = ( api, clock() )
+        _overridden.discard( entity_id )
+        if state == "off" and not kwargs and (bulk := getattr( _local, "bulk", None )):
+            bulk.add( entity_id )
+        elif get_mesh( api ).submit( api, state, entity_id, kwargs, priority, metrics ):
+            return True     # queued, counted in metrics when sent
+    if metrics:
+        metrics.command( sent )
+    return sent
+
+"""
+    One command for a list of entities. The redundancy check is done for
+    each of them, and those left get a single command: to group if given,
+    an entity standing for all of them (a Home Assistant light group, or a
+    zigbee2mqtt group, see _send()), else one service call listing them.
+    Either way it counts as one command in the Mesh and the metrics, so
+    fading a room costs the same whatever its number of bulbs.
+
+    Each entity is remembered as if commanded alone: echoes, forget(),
+    override() and grug_reconcile keep working per entity.
+"""
+def _command_many( api, state, entity_ids, group, force, priority, kwargs ):
+    if len( entity_ids ) == 1 and not group:
+        return _command( api, state, entity_ids[0], force, priority, kwargs )
+    cmd = _key( state, kwargs )
+    targets = tuple( e for e in entity_ids if force or not _redundant( e, cmd ))
+    metrics = grug_metrics.current()
+    if targets:
+        t = clock()
+        for entity_id in targets:
+            _last[ entity_id ] = cmd
+            _owner[ entity_id ] = ( api, t )
+            _overridden.discard( entity_id )
+        if group:
+            _groups[ group ] = tuple( entity_ids )
+        if state == "off" and not kwargs and (bulk := getattr( _local, "bulk", None )):
+            for entity_id in ( [ group ] if group else targets ):
+                bulk.add( entity_id )
+        elif get_mesh( api ).submit( api, state, group or targets, kwargs, priority, metrics ):
+            return True     # queued, counted in metrics when sent
+    if metrics:
+        metrics.command( bool( targets ))
+    return bool( targets )
+
+"""
+    Outputs from a yaml setting: one entity_id, or a list of them.
+"""
+def entity_list( value ):
+    return [ value ] if isinstance( value, str ) else list( value )
+
+"""
+    Entities a Mesh queue key stands for: an entity, a group, or a tuple
+    of entities.
+"""
+def _members( target ):
+    if isinstance( target, tuple ):
+        return target
+    return _groups.get( target, ( target, ))
+
+"""
+    Outgoing command scheduler of one radio mesh or integration.
+
+    A Zigbee coordinator queues everything it gets FIFO, so a light turned
+    on by motion waits behind the fade steps of every other room. Commands
+    are rate limited here instead, with a token bucket: "command_rate" per
+    second, bursts of up to "command_burst". While tokens are left and
+    nothing is queued, a command goes out immediately. Otherwise it is
+    queued by priority, and a timer sends the queue as tokens come back.
+
+    A queued command is dropped when a newer command for the same entity
+    is queued: only the last one matters. A command for several entities
+    is queued under the group, or the tuple of entities, it is sent to.
+
+    Apps pick their mesh with "command_mesh" in their yaml config (default
+    "default"). The first app using a mesh sets its rate and burst.
+    Queue depth and wait time are published with grug.metrics.
+"""
+class Mesh:
+    def __init__( self, name, rate, burst ):
+        self.name    = name
+        self.rate    = rate
+        self.burst   = burst
+        self.tokens  = burst
+        self.stamp   = clock()      # clock() time tokens were last refilled
+        self.queue   = []           # heap of [ priority, seq, entity_id, command ], command is None when dropped
+        self.seq     = itertools.count()
+        self.pending = {}           # entity_id, group or tuple of entities -> queue entry
+        self.host    = None         # api of the drain timer
+        self.handle  = None         # drain timer handle, if armed
+        self.lock    = threading.Lock()
+        self.max_depth  = 0
+        self.superseded = 0
+        self.wait_ms    = grug_metrics.Histogram()
+
+    """
+        Send the command now if possible and return False.
+        Otherwise queue it and return True.
+    """
+    def submit( self, api, state, entity_id, kwargs, priority, metrics ):
+        with self.lock:
+            if old := self.pending.pop( entity_id, None ):
+                old[3] = None
+                self.superseded += 1
+            now = not self.pending and self._take()
+            if not now:
+                start = metrics.event_start if metrics else None
+                if metrics:
+                    metrics.event_start = None      # latency is recorded when it is sent
+                entry = [ priority, next( self.seq ), entity_id, ( api, state, kwargs, metrics, start, clock() ) ]
+                heapq.heappush( self.queue, entry )
+                self.pending[ entity_id ] = entry
+                self.max_depth = max( self.max_depth, len( self.pending ))
+                self._arm( api )
+        if now:
+            _send( api, state, entity_id, kwargs )
+        return not now
+
+    """
+        Drop the queued commands of an app, and move the drain timer to
+        another app if it was armed by this one.
+    """
+    def unregister( self, api ):
+        with self.lock:
+            for entity_id, entry in list( self.pending.items() ):
+                if entry[3][0] is api:
+                    entry[3] = None
+                    del self.pending[ entity_id ]
+            if self.host is api:
+                if isinstance( self.handle, asyncio.TimerHandle ):
+                    self.handle.cancel()
+                self.host = self.handle = None
+                if self.pending:
+                    self._arm( next( iter( self.pending.values() ))[3][0] )
+
+    def _take( self ):
+        t = clock()
+        self.tokens = min( self.burst, self.tokens + (t - self.stamp) * self.rate )
+        self.stamp = t
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def _arm( self, api ):
+        if self.handle is not None or not self.pending:
+            return
+        delay = max( 0.001, (1 - self.tokens) / self.rate )
+        self.host = api
+        try:
+            self.handle = asyncio.get_running_loop().call_later( delay, self._drain )
+        except RuntimeError:
+            self.handle = api.run_in( lambda kwargs: self._drain(), delay )
+
+    def _drain( self ):
+        sends = []
+        with self.lock:
+            self.handle = None
+            while self.pending and self._take():
+                entry = heapq.heappop( self.queue )
+                while entry[3] is None:
+                    entry = heapq.heappop( self.queue )
+                del self.pending[ entry[2] ]
+                sends.append(( entry[2], entry[3] ))
+            if self.pending:
+                self._arm( self.host )
+            else:
+                self.queue.clear()
+        t = clock()
+        for entity_id, ( api, state, kwargs, metrics, start, queued ) in sends:
+            wait_ms = (t - queued) * 1000
+            self.wait_ms.add( wait_ms )
+            if metrics:
+                metrics.queued( wait_ms, start )
+            _send( api, state, entity_id, kwargs )
+
+    def as_dict( self ):
+        return {
+            "depth":        len( self.pending ),
+            "max_depth":    self.max_depth,
+            "superseded":   self.superseded,
+            "wait":         self.wait_ms.as_dict(),
+        }
+
+"""
+    Output drivers.
+
+    Entities listed in the "mqtt_outputs" mapping of the app's yaml config
+    are driven directly over MQTT, skipping the Home Assistant hop:
+
+        mqtt_outputs:
+          light.ampoule_ikea_4: z2m/ampoule_ikea_4
+
+    A command is published to "<topic>/set" as a zigbee2mqtt payload, like
+    { "state": "ON", "brightness": 128, "transition": 2 }. Other entities
+    get a Home Assistant service call.
+
+    A group given to turn_on() or turn_off() can be listed too, with the
+    topic of a zigbee2mqtt group: the bulbs then get a single broadcast on
+    the mesh. A tuple of entities gets one service call per domain, with
+    the list of entities, and one publish per entity listed here.
+"""
+def _send( api, state, target, kwargs ):
+    outputs = api.args.get( "mqtt_outputs", {} )
+    if isinstance( target, tuple ):
+        domains = {}
+        for entity_id in target:
+            if topic := outputs.get( entity_id ):
+                _publish( api, topic, state, kwargs )
+            else:
+                domains.setdefault( entity_id.split( "." )[0], [] ).append( entity_id )
+        for domain, entities in domains.items():
+            api.call_service( "%s/turn_%s" % ( domain, state ), entity_id=entities, **kwargs )
+    elif topic := outputs.get( target ):
+        _publish( api, topic, state, kwargs )
+    elif state == "on":
+        api.turn_on( target, **kwargs )
+    else:
+        api.turn_off( target, **kwargs )
+
+def _publish( api, topic, state, kwargs ):
+    payload = dict( kwargs, state=state.upper() )
+    _mqtt( api ).mqtt_publish( topic + "/set", json.dumps( payload ))
+
+_mqtt_apis = weakref.WeakKeyDictionary()
+
+def _mqtt( api ):
+    mqtt = _mqtt_apis.get( api )
+    if mqtt is None:
+        mqtt = _mqtt_apis[ api ] = api.get_plugin_api( "MQTT" )
+    return mqtt
+
+_meshes = {}    # name -> Mesh
+
+"""
+    Returns the Mesh this app sends its commands through.
+"""
+def get_mesh( api ):
+    name = api.args.get( "command_mesh", "default" )
+    mesh = _meshes.get( name )
+    if mesh is None:
+        mesh = _meshes[ name ] = Mesh( name, api.args.get( "command_rate", 10 ), api.args.get( "command_burst", 10 ))
+    return mesh
+
+"""
+    Drop the queued commands of this app, call from terminate().
+"""
+def unregister( api ):
+    for mesh in list( _meshes.values() ):
+        mesh.unregister( api )
+    for entity_id, ( a, t ) in list( _owner.items() ):
+        if a is api:
+            del _owner[ entity_id ]
+
+def stats():
+    return { name:mesh.as_dict() for name, mesh in list( _meshes.items() ) }
+
+grug_metrics.add_source( "meshes", stats )
+
+"""
+    Forget the last command, so the next one is always sent.
+"""
+def forget( entity_id ):
+    _last.pop( entity_id, None )
+    _owner.pop( entity_id, None )
+
+"""
+    The entity was changed by someone else (a wall switch, Home Assistant):
+    it is left out of desired() until our next command for it. Call from
+    the listen_state callbacks of outputs, when they detect manual control.
+    Ignored while a command for it is queued, the change is probably the
+    echo of an older one.
+"""
+def override( entity_id ):
+    if not queued( entity_id ):
+        _overridden.add( entity_id )
+
+"""
+    State of our last command to entity_id, None if none.
+"""
+def commanded( entity_id ):
+    cmd = _last.get( entity_id )
+    return cmd[0] if cmd else None
+
+"""
+    The state we want outputs in, for grug_reconcile:
+    { entity_id: ( ( state, attrs ), api, clock() time sent ) } of the last
+    command sent by an app still running, except entities under manual control.
+"""
+def desired():
+    return { entity_id:( _last[ entity_id ], api, t ) for entity_id, ( api, t ) in list( _owner.items() )
+             if entity_id in _last and entity_id not in _overridden }
+
+"""
+    True if a command for entity_id waits in a Mesh queue.
+"""
+def queued( entity_id ):
+    for mesh in list( _meshes.values() ):
+        if entity_id in mesh.pending or any( entity_id in _members( t ) for t in list( mesh.pending )):
+            return True
+    return False
+
+"""
+    Send the last command to entity_id again, at FADE priority, through the
+    Mesh of the app that sent it. What is remembered does not change.
+"""
+def resend( entity_id ):
+    cmd, owner = _last.get( entity_id ), _owner.get( entity_id )
+    if cmd and owner:
+        ( state, attrs ), api = cmd, owner[0]
+        get_mesh( api ).submit( api, state, entity_id, dict( attrs ), FADE, None )
+
+"""
+    Bulk off: collects the plain turn_off() issued by "count" callbacks,
+    possibly running in different apps and threads, and sends them as a
+    single homeassistant/turn_off service call once the last one is done.
+
+    Each callback is run with bulk.run( api, func ). A callback that will
+    not run after all must still be accounted for with bulk.done().
+"""
+class BulkOff:
+    def __init__( self, count ):
+        self.count    = count
+        self.entities = []
+        self.api      = None        # api of the last callback, sends the service call
+        self.lock     = threading.Lock()
+
+    def run( self, api, func ):
+        _local.bulk = self
+        try:
+            func()
+        finally:
+            _local.bulk = None
+            self.done( api )
+
+    def add( self, entity_id ):
+        with self.lock:
+            self.entities.append( entity_id )
+
+    def done( self, api=None ):
+        with self.lock:
+            self.api = api or self.api
+            self.count -= 1
+            if self.count > 0 or not self.entities:
+                return
+            entities, self.entities = self.entities, []
+        self.api.log( "Bulk off: %s", ", ".join( entities ))
+        self.api.call_service( "homeassistant/turn_off", entity_id=entities )
@@ -0,0 +1,40 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import time
+
+"""
+    In-memory state handed from a terminating actor to its replacement.
+
+    Editing grug_timeout or grug_persist reloads every app. Instead of
+    saving its state and reading it back, an actor deposits its live state
+    with put() in terminate(), and the new instance takes it with take()
+    when it starts. Times stay in time.monotonic() seconds, so timers
+    resume exactly where they were. When nothing was handed over (first
+    start, AppDaemon restart), actors load their persisted state.
+
+    This module imports nothing of ours, so reloading the other modules
+    does not reload it and the deposits survive. Keys are actor names, or
+    any other hashable unique in the process. A deposit not taken within
+    MAX_AGE seconds is dropped: the app was removed, or took too long to
+    come back for its state to be trusted.
+"""
+MAX_AGE = 60
+
+_deposits = {}      # key -> ( time.monotonic() of deposit, state )
+
+def put( key, state ):
+    t = time.monotonic()
+    for k in [ k for k, ( at, s ) in _deposits.items() if t - at > MAX_AGE ]:
+        del _deposits[ k ]
+    _deposits[ key ] = ( t, state )
+
+"""
+    Returns the state deposited under key, and forgets it. None if there
+    is none, or if it is too old.
+"""
+def take( key ):
+    d = _deposits.pop( key, None )
+    if d is None or time.monotonic() - d[0] > MAX_AGE:
+        return None
+    return d[1]
@@ -0,0 +1,73 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import yaml
+
+"""
+    Declarative state machines for the actors.
+
+    An actor class describes how it reacts to events in YAML:
+
+        states:  [ "on", "off", manual ]
+        initial: manual
+        transitions:
+          - { from: "*",   event: sensor_on, do: [ light_on ], to: "on" }
+          - { from: "on",  event: light_on }                # echo of our command
+          - { from: "*",   event: [ light_off, light_other ], do: [ manual ], to: manual }
+
+        from    a state, a list of states, or "*" for all of them
+        event   an event name, or a list of them
+        do      methods of the actor called in order, with the event arguments
+        to      state after the transition, the current one if omitted
+
+    The first transition listed for a ( state, event ) pair wins, so
+    specific transitions go before "*" ones. Quote "on" and "off": YAML
+    reads them as booleans.
+
+    Machine() compiles it when the module is loaded into a flat table
+    { ( state, event ): ( functions, state ) }, checking that states and
+    methods exist. Firing an event is then one dict lookup: the actor's
+    .state is changed first, then the functions are called. An event with
+    no transition from the current state is ignored.
+
+    Methods are looked up on the class given to Machine(): subclasses share
+    the table, and must not override the methods it calls.
+"""
+class Machine:
+    def __init__( self, cls, definition ):
+        d = yaml.safe_load( definition )
+        self.states  = d[ "states" ]
+        self.initial = d[ "initial" ]
+        self.table   = {}
+        for t in d[ "transitions" ]:
+            froms  = self.states if t[ "from" ] == "*" else _list( t[ "from" ] )
+            to     = t.get( "to" )
+            for state in froms + ( [ to ] if to is not None else [] ):
+                if state not in self.states:
+                    raise ValueError( "%s: unknown state %r" % ( cls.__name__, state ))
+            actions = []
+            for name in _list( t.get( "do", [] )):
+                if not callable( getattr( cls, name, None )):
+                    raise ValueError( "%s: no method %r" % ( cls.__name__, name ))
+                actions.append( getattr( cls, name ))
+            for state in froms:
+                for event in _list( t[ "event" ] ):
+                    self.table.setdefault(( state, event ), ( tuple( actions ), to ))
+
+    """
+        Handle event in actor. Returns False if there is no transition for
+        it in the current state.
+    """
+    def fire( self, actor, event, *args ):
+        t = self.table.get(( actor.state, event ))
+        if t is None:
+            return False
+        actions, to = t
+        if to is not None:
+            actor.state = to
+        for action in actions:
+            action( actor, *args )
+        return True
+
+def _list( x ):
+    return x if isinstance( x, list ) else [ x ]
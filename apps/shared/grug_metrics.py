@@ -0,0 +1,188 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import time, bisect, threading, asyncio, datetime
+
+"""
+    Per-actor performance metrics.
+
+    Each actor registers a Metrics object and wraps its callbacks with
+    Metrics.timed(). While a wrapped callback runs, its Metrics is the
+    "current" one for the thread, so grug_timeout, grug_persist and
+    grug_command can count their work without being told which actor
+    they work for.
+
+    Counters are plain ints and histograms updated in memory. All actors
+    are published together every "metrics_interval" seconds (default 300)
+    as the attributes of a single entity in the userapps namespace:
+    grug.metrics. Nothing is written per event.
+"""
+BUCKETS_MS = ( 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000 )
+ENTITY     = "grug.metrics"
+NAMESPACE  = "userapps"
+
+class Histogram:
+    def __init__( self ):
+        self.counts = [0] * (len( BUCKETS_MS ) + 1)
+        self.count  = 0
+        self.total  = 0.0
+        self.max    = 0.0
+
+    def add( self, ms ):
+        self.counts[ bisect.bisect_left( BUCKETS_MS, ms ) ] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def as_dict( self ):
+        buckets = { "<=%s" % b:n for b, n in zip( BUCKETS_MS, self.counts ) if n }
+        if self.counts[-1]:
+            buckets[ ">%s" % BUCKETS_MS[-1] ] = self.counts[-1]
+        return {
+            "count":    self.count,
+            "avg_ms":   round( self.total / self.count, 3 ) if self.count else 0,
+            "max_ms":   round( self.max, 3 ),
+            "buckets":  buckets,
+        }
+
+class Metrics:
+    def __init__( self, name ):
+        self.name                = name
+        self.callback_ms         = Histogram()  # callback execution time
+        self.latency_ms          = Histogram()  # input event to first command sent
+        self.queue_ms            = Histogram()  # time commands waited in the grug_command queue
+        self.reschedules         = 0
+        self.persist_writes      = 0
+        self.persist_bytes       = 0
+        self.commands_issued     = 0
+        self.commands_suppressed = 0
+        self.event_start         = None         # perf_counter() when the current input event started
+
+    """
+        Wrap a callback to time it and make this Metrics current while it runs.
+        With latency=True (sensor or button events), the time until the first
+        command it sends is recorded as latency.
+    """
+    def timed( self, func, latency=False ):
+        def wrapper( *args, **kwargs ):
+            prev = getattr( _local, "metrics", None )
+            _local.metrics = self
+            t = time.perf_counter()
+            if latency:
+                self.event_start = t
+            try:
+                return func( *args, **kwargs )
+            finally:
+                self.callback_ms.add( (time.perf_counter() - t) * 1000 )
+                self.event_start = None
+                _local.metrics = prev
+        return wrapper
+
+    def command( self, sent ):
+        if not sent:
+            self.commands_suppressed += 1
+            return
+        self.commands_issued += 1
+        if self.event_start is not None:
+            self.latency_ms.add( (time.perf_counter() - self.event_start) * 1000 )
+            self.event_start = None
+
+    """
+        A command queued by grug_command was sent after waiting wait_ms.
+        start is the event_start of the event that queued it.
+    """
+    def queued( self, wait_ms, start ):
+        self.commands_issued += 1
+        self.queue_ms.add( wait_ms )
+        if start is not None:
+            self.latency_ms.add( (time.perf_counter() - start) * 1000 )
+
+    def as_dict( self ):
+        return {
+            "callback":             self.callback_ms.as_dict(),
+            "latency":              self.latency_ms.as_dict(),
+            "queue":                self.queue_ms.as_dict(),
+            "reschedules":          self.reschedules,
+            "persist_writes":       self.persist_writes,
+            "persist_bytes":        self.persist_bytes,
+            "commands_issued":      self.commands_issued,
+            "commands_suppressed":  self.commands_suppressed,
+        }
+
+_local = threading.local()
+
+"""
+    Metrics of the actor whose callback is running on this thread, or None.
+"""
+def current():
+    return getattr( _local, "metrics", None )
+
+_registry = {}          # name -> ( api, Metrics )
+_sources  = {}          # name -> function returning a dict, published along with the actors
+_host     = None        # api of the app publishing the entity
+_handle   = None
+
+"""
+    Register an actor and return its Metrics.
+    The first app to register publishes the entity for everyone.
+"""
+def register( api, name ):
+    metrics = Metrics( name )
+    _registry[ name ] = ( api, metrics )
+    if _host is None:
+        _start( api )
+    return metrics
+
+"""
+    Remove the actors of this app, call from terminate().
+    If it was publishing, another registered app takes over.
+"""
+def unregister( api ):
+    global _host, _handle
+    for name, (a, m) in list( _registry.items() ):
+        if a is api:
+            del _registry[ name ]
+    if _host is api:
+        if isinstance( _handle, asyncio.TimerHandle ):
+            _handle.cancel()
+        elif _handle is not None:
+            api.cancel_timer( _handle )
+        _host = _handle = None
+        if _registry:
+            _start( next( iter( _registry.values() ))[0] )
+
+"""
+    Publish the dict returned by func() under name, along with the actors.
+    For shared modules with figures of their own.
+"""
+def add_source( name, func ):
+    _sources[ name ] = func
+
+def _start( api ):
+    global _host, _handle
+    _host = api
+    interval = api.args.get( "metrics_interval", 300 )
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        start = api.get_now() + datetime.timedelta( seconds=interval )
+        _handle = api.run_every( lambda kwargs: publish(), start, interval )
+    else:
+        def tick():
+            global _handle
+            publish()
+            _handle = loop.call_later( interval, tick )
+        _handle = loop.call_later( interval, tick )
+
+"""
+    Write all registered actors' metrics into the grug.metrics entity.
+"""
+def publish():
+    if _host is None:
+        return
+    attrs = { name:m.as_dict() for name, (api, m) in list( _registry.items() ) }
+    state = len( attrs )
+    for name, func in list( _sources.items() ):
+        attrs[ name ] = func()
+    _host.set_state( ENTITY, state=state, attributes=attrs, namespace=NAMESPACE )
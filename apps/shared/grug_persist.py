@@ -1,6 +1,425 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import weakref, threading, asyncio, os, json, datetime
+
+import grug_metrics
+
+NAMESPACE = "userapps"
+
+"""
+    Storage backends. A backend loads everything at once with load_all(),
+    and writes the batches of saves flushed by the Writers.
+
+    There is one backend for the whole process, set with "persist_backend"
+    on the grug_persist entry of apps.yaml, not on the apps:
+        namespace   entities in the userapps namespace (default)
+        journal     append-only journal in the AppDaemon config dir,
+                    or "persist_path" if set
+
+        grug_persist:
+          module: grug_persist
+          global: true
+          persist_backend: journal
+"""
+class NamespaceBackend:
+    name = "namespace"
+
+    def load_all( self, api ):
+        return dict( api.get_state( namespace=NAMESPACE ) or {} )
+
+    async def aload_all( self, api ):
+        return dict( await api.get_state( namespace=NAMESPACE ) or {} )
+
+    """
+        items is a list of ( entity_id, state, attrs ), creates a list of
+        entity_id to create.
+    """
+    def write( self, api, items, creates ):
+        for entity_id in creates:
+            api.get_entity( entity_id, namespace=NAMESPACE ).add()
+        for entity_id, state, attrs in items:
+            api.set_state( entity_id, state=state, attributes=attrs, namespace=NAMESPACE )
+
+    """
+        Same as write(), for async apps, waiting for AppDaemon to store them.
+    """
+    async def awrite( self, api, items, creates ):
+        for entity_id in creates:
+            await api.get_entity( entity_id, namespace=NAMESPACE ).add()
+        for entity_id, state, attrs in items:
+            await api.set_state( entity_id, state=state, attributes=attrs, namespace=NAMESPACE )
+
+    def commit( self ):
+        pass
+
+"""
+    Append-only journal of JSON lines, one per save, next to a snapshot
+    of all entities.
+
+    On startup, the snapshot and the journal are read sequentially, once,
+    to restore every actor. Writes are appended in batches, one fsync per
+    batch. After COMPACT_EVERY records, the whole state is written into a
+    new snapshot and the journal is truncated.
+
+    If neither file exists, the userapps namespace is migrated once into
+    a new snapshot.
+"""
+class JournalBackend:
+    name = "journal"
+    COMPACT_EVERY = 1000
+
+    def __init__( self, path ):
+        self.path     = path
+        self.snapshot = os.path.join( path, "snapshot.json" )
+        self.journal  = os.path.join( path, "journal.jsonl" )
+        self.lock     = threading.Lock()
+        self.pending  = []      # encoded lines not written yet
+        self.records  = 0       # lines in the journal
+        self.file     = None
+
+    def load_all( self, api ):
+        if self._exists():
+            return self._read()
+        return self._migrate( api, NamespaceBackend().load_all( api ))
+
+    async def aload_all( self, api ):
+        if self._exists():
+            return self._read()
+        return self._migrate( api, await NamespaceBackend().aload_all( api ))
+
+    def write( self, api, items, creates ):
+        lines = [ json.dumps( { "e":entity_id, "s":state, "a":attrs }, default=_encode ) + "\n"
+                  for entity_id, state, attrs in items ]
+        with self.lock:
+            self.pending.extend( lines )
+
+    async def awrite( self, api, items, creates ):
+        self.write( api, items, creates )
+
+    def commit( self ):
+        with self.lock:
+            if not self.pending:
+                return
+            lines, self.pending = self.pending, []
+            if self.file is None:
+                self._open()
+            self.file.write( "".join( lines ))
+            self.file.flush()
+            os.fsync( self.file.fileno() )
+            self.records += len( lines )
+            if self.records >= self.COMPACT_EVERY and _cache is not None:
+                self._compact( dict( _cache ))
+
+    def _exists( self ):
+        return os.path.exists( self.snapshot ) or os.path.exists( self.journal )
+
+    def _read( self ):
+        states = {}
+        if os.path.exists( self.snapshot ):
+            with open( self.snapshot ) as f:
+                states = json.load( f, object_hook=_decode )
+        if os.path.exists( self.journal ):
+            with open( self.journal ) as f:
+                for line in f:
+                    try:
+                        r = json.loads( line, object_hook=_decode )
+                    except ValueError:
+                        break       # torn last line after a crash
+                    states[ r["e"] ] = { "state":r["s"], "attributes":r["a"] }
+                    self.records += 1
+        self.file = open( self.journal, "a" )
+        return states
+
+    """
+        Open the journal for appending without reading it. Only after
+        grug_persist was reloaded while its apps were handed their state
+        over in memory (see grug_handoff): the records are not counted, so
+        compaction comes later than usual.
+    """
+    def _open( self ):
+        os.makedirs( self.path, exist_ok=True )
+        self.file = open( self.journal, "a" )
+
+    def _migrate( self, api, states ):
+        api.log( "grug_persist: migrating %d entities from namespace %s to %s", len( states ), NAMESPACE, self.path )
+        states = { k:{ "state":v.get( "state" ), "attributes":v.get( "attributes", {} ) } for k, v in states.items() }
+        os.makedirs( self.path, exist_ok=True )
+        self._compact( states )
+        return states
+
+    """
+        Write states into a new snapshot, atomically, then truncate the journal.
+    """
+    def _compact( self, states ):
+        tmp = self.snapshot + ".tmp"
+        with open( tmp, "w" ) as f:
+            json.dump( states, f, default=_encode )
+            f.flush()
+            os.fsync( f.fileno() )
+        os.replace( tmp, self.snapshot )
+        if self.file:
+            self.file.close()
+        self.file = open( self.journal, "w" )
+        self.records = 0
+
+def _encode( o ):
+    if isinstance( o, datetime.datetime ):
+        return { "$dt":o.isoformat() }
+    raise TypeError( "Can't persist %r" % (o,) )
+
+def _decode( d ):
+    if len( d ) == 1 and "$dt" in d:
+        return datetime.datetime.fromisoformat( d["$dt"] )
+    return d
+
+_backend = None
+
+def get_backend( api ):
+    global _backend
+    if _backend is None:
+        config = api.app_config.get( "grug_persist" ) or {}
+        kind = config.get( "persist_backend", "namespace" )
+        if kind == "journal":
+            _backend = JournalBackend( config.get( "persist_path" ) or os.path.join( api.config_dir, "grug_persist" ))
+        elif kind == "namespace":
+            _backend = NamespaceBackend()
+        else:
+            raise ValueError( "grug_persist: unknown persist_backend %r" % kind )
+    return _backend
+
+"""
+    Process-wide cache of all persisted entities, shared by all apps.
+
+    Everything is loaded with a single backend read the first time any app
+    loads something, then every _load() is served from memory.
+    Writer.save() updates the cache immediately, so it stays current when an
+    app is reloaded and restores from it.
+"""
+_cache      = None      # entity_id -> { "state":..., "attributes":... }
+_cache_lock = threading.Lock()
+
+def preload( api ):
+    global _cache
+    _check_args( api )
+    with _cache_lock:
+        if _cache is None:
+            _cache = get_backend( api ).load_all( api )
+    return _cache
+
+#   Refuse to start an app that still sets the backend itself: it would
+#   silently use the one of grug_persist instead.
+#
+def _check_args( api ):
+    for key in ( "persist_backend", "persist_path" ):
+        if key in api.args:
+            raise ValueError( "%s: %s is set on grug_persist in apps.yaml, not on the apps" % ( api.name, key ))
+
+"""
+    Same as preload(), for async apps. Await it before the first _load().
+"""
+async def apreload( api ):
+    global _cache
+    _check_args( api )
+    if _cache is None:
+        states = await get_backend( api ).aload_all( api )
+        if _cache is None:
+            _cache = states
+    return _cache
+
+"""
+    Write-behind for PersistMixin._save().
+
+    A save only records the latest state and attributes of the entity and
+    marks it dirty. A single flush, scheduled "delay" seconds after the first
+    dirty save, writes each dirty entity once. With the default delay of 0
+    the flush runs right after the current callback returns, so an event
+    that saves the same timer three times results in one write. Inside a
+    grug_timeout.snapshot() callback, that is done when it returns, see
+    end_batch(), without an AppDaemon timer.
+
+    The delay can be set per app with "persist_delay" in its yaml config.
+"""
+class Writer:
+    def __init__( self, api, delay = 0 ):
+        self.api    = api
+        self.delay  = delay
+        self.dirty  = {}        # entity_id -> ( state, attrs, metrics ), or None to create the entity
+        self.handle = None      # AppDaemon timer handle for the pending flush
+        self.batched = False    # flush pending in end_batch()
+
+    def save( self, entity_id, state, attrs ):
+        self.dirty[ entity_id ] = ( state, attrs, grug_metrics.current() )
+        if _cache is not None:
+            _cache[ entity_id ] = { "state":state, "attributes":attrs }
+        self._schedule()
+
+    """
+        Create a missing entity on next flush, unless it is saved before that.
+    """
+    def create( self, entity_id ):
+        self.dirty.setdefault( entity_id, None )
+        self._schedule()
+
+    def _schedule( self ):
+        if self.handle is None and not self._batch():
+            self.handle = self.api.run_in( self._flush_callback, self.delay )
+
+    """
+        With no delay, inside a snapshot() callback, leave the flush to
+        end_batch(). Returns False if the flush must be scheduled.
+    """
+    def _batch( self ):
+        if self.batched:
+            return True
+        batch = getattr( _local, "batch", None )
+        if self.delay or batch is None:
+            return False
+        self.batched = True
+        batch.append( self )
+        return True
+
+    """
+        Write all dirty entities now. Called on terminate() so nothing is lost.
+    """
+    def flush( self ):
+        if self.handle is not None:
+            self.api.cancel_timer( self.handle )
+            self.handle = None
+        self._commit( self._write() )
+
+    def _flush_callback( self, kwargs ):
+        self.handle = None
+        self._commit( self._write() )
+
+    """
+        Hand the dirty entities to the backend. Returns it, for the caller
+        to commit.
+    """
+    def _write( self ):
+        backend = get_backend( self.api )
+        backend.write( self.api, *self._take() )
+        return backend
+
+    """
+        Returns the dirty entities as ( items, creates ) for the backend,
+        and marks them clean.
+    """
+    def _take( self ):
+        dirty, self.dirty = self.dirty, {}
+        items, creates = [], []
+        for entity_id, d in dirty.items():
+            if d is None:
+                creates.append( entity_id )
+            else:
+                state, attrs, metrics = d
+                items.append(( entity_id, state, attrs ))
+                if metrics:
+                    metrics.persist_writes += 1
+                    metrics.persist_bytes  += len( repr( attrs )) + len( str( state ))
+        return items, creates
+
+    def _commit( self, backend ):
+        backend.commit()
+
+"""
+    Same as Writer, for async apps: the flush is an asyncio timer on the
+    event loop, and writes are sent without waiting for them. Flushes from
+    the asyncio timer commit in a worker thread. On terminate, await
+    aflush(): AppDaemon cancels what the app left running when terminate
+    returns.
+"""
+class AsyncWriter( Writer ):
+    def flush( self ):
+        self._cancel()
+        self._write().commit()
+
+    """
+        Write all dirty entities and wait until they are stored.
+    """
+    async def aflush( self ):
+        self._cancel()
+        backend = get_backend( self.api )
+        await backend.awrite( self.api, *self._take() )
+        backend.commit()
+
+    def _cancel( self ):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def _schedule( self ):
+        if self.handle is None and not self._batch():
+            self.handle = asyncio.get_running_loop().call_later( self.delay, self._flush_callback, None )
+
+    #   fsync in a worker thread, not on the event loop
+    def _commit( self, backend ):
+        asyncio.get_running_loop().run_in_executor( None, backend.commit )
+
+_writers = weakref.WeakKeyDictionary()
+_local   = threading.local()
+
+"""
+    grug_timeout.snapshot() calls begin_batch() when the outermost callback
+    starts, and end_batch() once it and the work it queued with after()
+    are done: the Writers without delay dirtied meanwhile flush then.
+"""
+def begin_batch():
+    _local.batch = []
+
+def end_batch():
+    writers, _local.batch = _local.batch, None
+    for writer in writers:
+        writer.batched = False
+        writer._commit( writer._write() )
+
+"""
+    Returns the Writer of this app, creating it on first use.
+    Apps running on the event loop get an AsyncWriter.
+"""
+def get_writer( api ):
+    writer = _writers.get( api )
+    if writer is None:
+        try:
+            asyncio.get_running_loop()
+            cls = AsyncWriter
+        except RuntimeError:
+            cls = Writer
+        if cls is Writer:
+            preload( api )      # not done yet by actors taking a handoff; async apps await apreload()
+        writer = _writers[ api ] = cls( api, api.args.get( "persist_delay", 0 ))
+    return writer
+
+"""
+    Synchronously write pending saves of this app.
+"""
+def flush( api ):
+    writer = _writers.get( api )
+    if writer is not None:
+        writer.flush()
+
+"""
+    Same as flush(), for async apps: await it from terminate().
+"""
+async def aflush( api ):
+    writer = _writers.get( api )
+    if writer is None:
+        return
+    if isinstance( writer, AsyncWriter ):
+        await writer.aflush()
+    else:
+        writer.flush()
+
+"""
+    Returns ( state, attributes ) of any persisted entity, ( None, {} ) if
+    missing. For schema migrations that read records of another entity.
+"""
+def peek( api, entity_id ):
+    d = preload( api ).get( entity_id )
+    if not d:
+        return None, {}
+    return d["state"], d["attributes"]
+
 #   Mixin to add to classes to persist states
 #   Class must have .api, 
 #
@@ -8,28 +427,15 @@ class PersistMixin:
     def _save( self, state, attrs ):
         if not self.entity_storage_id:
             return
-        try:
-            old_namespace = self.api.get_namespace()
-            self.api.set_namespace( "userapps" )
-            self.api.set_state( self.entity_storage_id, state=state, attributes = attrs )
-        finally:
-            self.api.set_namespace( old_namespace )
+        get_writer( self.api ).save( self.entity_storage_id, state, attrs )
 
     def _load( self ):
         if not self.entity_storage_id:
             return None, {}
-        try:
-            old_namespace = self.api.get_namespace()
-            self.api.set_namespace( "userapps" )
-            # self.api.log( "Loading %s", self.entity_storage_id )
-            d = self.api.get_state( self.entity_storage_id, attribute="all", default={} )
-            self.debug( "Loading %s: %s", self.entity_storage_id, d )
-            if not d:
-                self.debug( "Creating entity %s", self.entity_storage_id )
-                ent = self.api.get_entity( self.entity_storage_id )
-                # ent.add( state = "off" )
-                ent.add()
-                return None, {}
-            return d["state"], d["attributes"]
-        finally:
-            self.api.set_namespace( old_namespace )
\ No newline at end of file
+        d = preload( self.api ).get( self.entity_storage_id )
+        self.debug( "Loading %s: %s", self.entity_storage_id, d )
+        if not d:
+            self.debug( "Creating entity %s", self.entity_storage_id )
+            get_writer( self.api ).create( self.entity_storage_id )
+            return None, {}
+        return d["state"], d["attributes"]
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import asyncio, datetime
+
+import grug_command, grug_state, grug_metrics
+
+"""
+    Periodic reconciliation of outputs with the state the actors want.
+
+    A command lost on the mesh leaves a light on until the next event for
+    its room. Every "reconcile_interval" seconds (default 60, 0 disables
+    it), one get_state() of all entities is compared with the last command
+    grug_command sent to each output (grug_command.desired()). The cost is
+    a single call per interval, whatever the number of rooms.
+
+    An output that is "on" when we last sent "off", or the reverse, gets
+    its last command again:
+    - only if it was sent more than "reconcile_grace" seconds ago (default
+      10), so the state change had time to come back
+    - only if no newer command is queued for it
+    - at most after 1, 2, 4... intervals for the same command, up to
+      "reconcile_max_backoff" seconds (default 3600), so a device that
+      left the mesh is not flooded.
+    Outputs neither "on" nor "off" (unavailable) are left alone, and so
+    are outputs under manual control, see grug_command.override().
+
+    The sweep runs in the first app to register, with its yaml settings.
+    Its counters are published in grug.metrics.
+"""
+_apps    = []       # registered apps, the first one runs the sweep
+_host    = None
+_handle  = None
+_backoff = {}       # entity_id -> [ clock() time of the command, resends, clock() time of the next resend ]
+_sweeps  = 0
+_resends = 0
+
+"""
+    Register an app controlling outputs with grug_command. The first one
+    runs the sweep.
+"""
+def register( api ):
+    if api not in _apps:
+        _apps.append( api )
+    if _host is None:
+        _start( api )
+
+"""
+    Call from terminate(). If this app ran the sweep, another one takes over.
+"""
+def unregister( api ):
+    global _host, _handle
+    if api in _apps:
+        _apps.remove( api )
+    if _host is api:
+        if isinstance( _handle, asyncio.TimerHandle ):
+            _handle.cancel()
+        elif _handle is not None:
+            api.cancel_timer( _handle )
+        _host = _handle = None
+        if _apps:
+            _start( _apps[0] )
+
+def _start( api ):
+    global _host, _handle
+    interval = api.args.get( "reconcile_interval", 60 )
+    if not interval:
+        return
+    _host = api
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        start = api.get_now() + datetime.timedelta( seconds=interval )
+        _handle = api.run_every( lambda kwargs: sweep( api.get_state() ), start, interval )
+    else:
+        async def asweep():
+            sweep( await api.get_state() )
+        def tick():
+            global _handle
+            loop.create_task( asweep() )
+            _handle = loop.call_later( interval, tick )
+        _handle = loop.call_later( interval, tick )
+
+"""
+    Compare states, { entity_id: { "state": ... } } as returned by
+    get_state(), with the desired states and resend what diverges.
+"""
+def sweep( states ):
+    global _sweeps, _resends
+    _sweeps += 1
+    args     = _host.args if _host else {}
+    interval = args.get( "reconcile_interval", 60 )
+    grace    = args.get( "reconcile_grace", 10 )
+    longest  = args.get( "reconcile_max_backoff", 3600 )
+    states   = states or {}
+    t = grug_command.clock()
+    desired = grug_command.desired()
+    for entity_id in [ e for e in _backoff if e not in desired ]:
+        del _backoff[ entity_id ]
+    for entity_id, ( ( state, attrs ), api, sent ) in desired.items():
+        actual = ( states.get( entity_id ) or {} ).get( "state" )
+        if actual not in ( "on", "off" ):
+            continue
+        grug_state.update( entity_id, actual )     # in case a state change was missed
+        if actual == state:
+            _backoff.pop( entity_id, None )
+            continue
+        if t - sent < grace or grug_command.queued( entity_id ):
+            continue
+        b = _backoff.get( entity_id )
+        if b is None or b[0] != sent:       # first resend of this command
+            b = _backoff[ entity_id ] = [ sent, 0, t ]
+        if t < b[2]:
+            continue
+        b[1] += 1
+        b[2] = t + min( longest, interval * 2 ** b[1] )
+        _resends += 1
+        api.log( "Reconcile: %s is %s, sending %s again (%d)", entity_id, actual, state, b[1] )
+        grug_command.resend( entity_id )
+
+def stats():
+    return { "sweeps":_sweeps, "resends":_resends, "backoff":len( _backoff ) }
+
+grug_metrics.add_source( "reconcile", stats )
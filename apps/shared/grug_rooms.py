@@ -0,0 +1,39 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+    Several rooms hosted by a single AppDaemon app.
+
+    Instead of one apps.yaml entry per room, an app can list its rooms:
+
+        lumiere_rc_pc:
+          module: motion_light_fade
+          class: MotionLightFade
+          fade: *default_fade
+          rooms:
+            - name: lumiere_rc_pc_entree
+              sensors: [ binary_sensor.dm4_occupancy ]
+              light: light.ampoule_ikea_4
+            - name: lumiere_rc_pc_sejour
+              ...
+
+    Every other key of the app is a default for all its rooms, which can
+    override it. Each room becomes an actor with its own name (so its
+    persisted state is the same as when it was an app of its own), and all
+    of them share the app's sensor hub, timer wheel, persistence writer and
+    command queue.
+
+    An app without "rooms" is a single room configured by the app itself.
+"""
+def configs( args ):
+    if "rooms" not in args:
+        return [ args ]
+    defaults = { k:v for k, v in args.items() if k != "rooms" }
+    return [ { **defaults, **room } for room in args["rooms"] ]
+
+"""
+    Prefix for the log lines of an actor: its name when the app hosts
+    several rooms, nothing otherwise.
+"""
+def log_prefix( args, name ):
+    return name + ": " if "rooms" in args else ""
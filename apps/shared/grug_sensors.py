@@ -0,0 +1,241 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import grug_timeout, grug_metrics, grug_handoff
+
+"""
+    Sensor subscription hub.
+
+    Several actors often watch the same motion sensors. Instead of each of
+    them calling listen_state() on every sensor, they subscribe a group of
+    sensors here: each sensor is registered once and its events are fanned
+    out to all groups containing it.
+
+    Each group keeps a count of its sensors currently "on", updated on every
+    transition, so "all sensors clear" is just count == 0.
+
+    Callbacks are called on the thread of the app that registered the
+    sensor, so a hub is shared only by apps running on the same AppDaemon
+    thread. AppDaemon hands out threads in turn, so apps sharing sensors
+    must be pinned to one thread with pin_thread in apps.yaml, otherwise
+    they share a hub only by chance. Apps not pinned at all (pin_app:
+    false) get a hub of their own. All async apps share one hub, their
+    callbacks run on the event loop.
+
+    Flapping sensors can be debounced: subscribe with debounce=seconds, or
+    a { sensor: seconds } mapping. The first transition to "on" is passed
+    on at once, so presence is not delayed, and opens a window of that many
+    seconds. Any other transition opens a window too. Transitions during a
+    window are absorbed, and at its end the groups get a single transition
+    to the last state received, if it differs from what they last saw.
+    When several groups debounce the same sensor, the longest window wins.
+    Received and absorbed events per sensor are published in grug.metrics.
+
+    When the last group of a sensor goes away, its state is deposited in
+    grug_handoff, so the groups of a reloaded app start with the right count.
+"""
+class SensorGroup:
+    def __init__( self, api, sensors, callback ):
+        self.api      = api
+        self.sensors  = sensors
+        self.callback = callback    # callback( entity, old, new )
+        self.count    = 0           # number of sensors in this group currently "on"
+
+    def occupied( self ):
+        return self.count > 0
+
+"""
+    Debounce window of one sensor.
+"""
+class Debounce:
+    def __init__( self, delay ):
+        self.delay     = delay
+        self.raw       = None   # last state received
+        self.timer     = None   # window, a DelayedCallbackF of the app registering the sensor
+        self.received  = 0
+        self.delivered = 0
+
+class Hub:
+    Timer = grug_timeout.DelayedCallbackF
+
+    def __init__( self ):
+        self.states    = {}     # sensor -> last state passed on to the groups
+        self.groups    = {}     # sensor -> [ SensorGroup ]
+        self.handles   = {}     # sensor -> ( api, listen_state handle )
+        self.debounces = {}     # sensor -> Debounce, for debounced sensors
+
+    def subscribe( self, api, sensors, callback, debounce=0 ):
+        group = SensorGroup( api, sensors, callback )
+        for sensor in self._attach( group, debounce ):
+            self.handles[ sensor ] = ( api, api.listen_state( self._on_state, sensor ) )
+        return group
+
+    """
+        Remove all groups of this app. Sensors it registered are handed over
+        to another app still subscribed to them.
+    """
+    def unsubscribe( self, api ):
+        for sensor, handle, host in self._detach( api ):
+            api.cancel_listen_state( handle )
+            if host:
+                self.handles[ sensor ] = ( host, host.listen_state( self._on_state, sensor ) )
+
+    """
+        Add group to the sensors it contains.
+        Returns the sensors that are not registered yet.
+    """
+    def _attach( self, group, debounce ):
+        new = []
+        for sensor in group.sensors:
+            if sensor not in self.handles:
+                self.handles[ sensor ] = ( group.api, None )
+                new.append( sensor )
+                if (state := grug_handoff.take(( "grug_sensors", sensor ))) is not None:
+                    self.states.setdefault( sensor, state )
+            self.groups.setdefault( sensor, [] ).append( group )
+            if self.states.get( sensor ) == "on":
+                group.count += 1
+            delay = debounce.get( sensor, 0 ) if isinstance( debounce, dict ) else debounce
+            if delay:
+                if (d := self.debounces.get( sensor )) is None:
+                    d = self.debounces[ sensor ] = Debounce( delay )
+                    self._window( sensor, d, self.handles[ sensor ][0] )
+                d.delay = max( d.delay, delay )
+        return new
+
+    """
+        (Re)create the debounce window timer of sensor in the app hosting it,
+        keeping what remains of a running window.
+    """
+    def _window( self, sensor, d, api ):
+        remaining = d.timer.remaining() if d.timer and d.timer.running() else 0
+        if d.timer:
+            d.timer.cancel()
+        d.timer = self.Timer( api, lambda: self._window_end( sensor ))
+        if remaining:
+            d.timer.set( remaining )
+
+    """
+        Remove groups of this app.
+        Returns ( sensor, handle, new host api or None ) for each sensor
+        registered by this app.
+    """
+    def _detach( self, api ):
+        moved = []
+        for sensor, groups in list( self.groups.items() ):
+            groups[:] = [ g for g in groups if g.api is not api ]
+            host, handle = self.handles[ sensor ]
+            if host is not api:
+                continue
+            if groups:
+                moved.append(( sensor, handle, groups[0].api ))
+                if d := self.debounces.get( sensor ):
+                    self._window( sensor, d, groups[0].api )
+            else:
+                moved.append(( sensor, handle, None ))
+                del self.handles[ sensor ], self.groups[ sensor ]
+                if (state := self.states.pop( sensor, None )) is not None:
+                    grug_handoff.put(( "grug_sensors", sensor ), state )
+                if d := self.debounces.pop( sensor, None ):
+                    d.timer.cancel()
+        return moved
+
+    @grug_timeout.snapshot
+    def _on_state( self, entity, attribute, old, new, kwargs ):
+        d = self.debounces.get( entity )
+        if d is None:
+            return self._deliver( entity, new )
+        d.received += 1
+        d.raw = new
+        if new == "on" and self.states.get( entity ) != "on":
+            d.delivered += 1
+            self._deliver( entity, new )        # presence goes out at once
+        if not d.timer.running():
+            d.timer.set( d.delay )
+
+    def _window_end( self, entity ):
+        d = self.debounces[ entity ]
+        if d.raw != self.states.get( entity ):
+            d.delivered += 1
+            self._deliver( entity, d.raw )
+
+    def _deliver( self, entity, new ):
+        old = self.states.get( entity )
+        self.states[ entity ] = new
+        groups = self.groups.get( entity, () )
+        if (old == "on") != (new == "on"):
+            delta = 1 if new == "on" else -1
+            for group in groups:
+                group.count += delta
+        for group in groups:
+            group.callback( entity, old, new )
+
+"""
+    Hub shared by all async apps: callbacks run on the event loop.
+"""
+class AsyncHub( Hub ):
+    Timer = grug_timeout.AsyncDelayedCallbackF
+
+    async def subscribe( self, api, sensors, callback, debounce=0 ):
+        group = SensorGroup( api, sensors, callback )
+        for sensor in self._attach( group, debounce ):
+            self.handles[ sensor ] = ( api, await api.listen_state( self._on_state_async, sensor ) )
+        return group
+
+    async def unsubscribe( self, api ):
+        for sensor, handle, host in self._detach( api ):
+            await api.cancel_listen_state( handle )
+            if host:
+                self.handles[ sensor ] = ( host, await host.listen_state( self._on_state_async, sensor ) )
+
+    async def _on_state_async( self, entity, attribute, old, new, kwargs ):
+        self._on_state( entity, attribute, old, new, kwargs )
+
+_hubs = {}
+
+def _hub_key( api ):
+    thread = api.get_pin_thread()
+    return ( "thread", thread ) if thread >= 0 else api
+
+def _get_hub( key, cls ):
+    hub = _hubs.get( key )
+    if hub is None:
+        hub = _hubs[ key ] = cls()
+    return hub
+
+"""
+    Subscribe callback( entity, old, new ) to state changes of sensors.
+    Returns the SensorGroup, which holds the count of sensors "on".
+"""
+def subscribe( api, sensors, callback, debounce=0 ):
+    return _get_hub( _hub_key( api ), Hub ).subscribe( api, sensors, callback, debounce )
+
+"""
+    Remove all subscriptions of this app, call from terminate().
+"""
+def unsubscribe( api ):
+    key = _hub_key( api )
+    hub = _hubs.get( key )
+    if hub is not None:
+        hub.unsubscribe( api )
+        if not hub.handles:
+            del _hubs[ key ]
+
+"""
+    Same as subscribe() and unsubscribe(), for async apps.
+"""
+async def asubscribe( api, sensors, callback, debounce=0 ):
+    return await _get_hub( "loop", AsyncHub ).subscribe( api, sensors, callback, debounce )
+
+async def aunsubscribe( api ):
+    hub = _hubs.get( "loop" )
+    if hub is not None:
+        await hub.unsubscribe( api )
+        if not hub.handles:
+            del _hubs[ "loop" ]
+
+def stats():
+    return { sensor:{ "received":d.received, "absorbed":d.received - d.delivered }
+             for hub in list( _hubs.values() ) for sensor, d in list( hub.debounces.items() ) }
+
+grug_metrics.add_source( "sensors", stats )
@@ -0,0 +1,38 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+    Local mirror of entity states, shared by all apps.
+
+    Actors seed it once with track() when they start, then keep it current
+    from the listen_state callbacks they already have on their outputs, by
+    calling update(). Reading a state is then a dict lookup instead of a
+    get_state() round trip.
+"""
+_states = {}
+
+"""
+    Fetch the current state of entity_id into the mirror and return it.
+"""
+def track( api, entity_id ):
+    state = _states[ entity_id ] = api.get_state( entity_id )
+    return state
+
+"""
+    Same as track(), for async apps.
+"""
+async def atrack( api, entity_id ):
+    state = _states[ entity_id ] = await api.get_state( entity_id )
+    return state
+
+"""
+    Record a state change, call from listen_state callbacks.
+"""
+def update( entity_id, state ):
+    _states[ entity_id ] = state
+
+"""
+    Last known state of entity_id, default if it is not tracked.
+"""
+def get( entity_id, default=None ):
+    return _states.get( entity_id, default )
@@ -1,277 +1,644 @@
-#!/usr/bin/python
-# -*- coding: utf-8 -*-
-
-import appdaemon.plugins.hass.hassapi as hassapi
-import time, asyncio, datetime, json
-
-import grug_persist
-
-"""
-    Calls the callback at the end of the timeout.
-    Timeout can be cancelled, prolonged, shortened.
-
-    It has 2 states:
-    - Expired:  timer=None, callback will not trigger
-    - Running:  timer valid, callback will trigger
-
-    expiry contains the expiration time (when the callback will be called).
-    It is not reset when the timeout is expired or cancelled.
-
-"""
-class DelayedCallbackF:
-    def __init__( self, api, callback ):
-        self.api = api
-        api.depends_on_module( grug_persist )
-        self.callback = callback
-        self.timer = None       # If timer is not None, the timer is running and will trigger the callback
-        self.expiry = 0         # Expiry is zero when canceled.
-        self.start_time = None  # Used to know for how long the timeout has been running. 
-
-    """
-        True if the timeout's callback will trigger in the future.
-        False if cancelled or paused.
-    """
-    def running( self ):
-        return bool( self.timer )
-
-    """
-        Remaining time in seconds.
-        0 if cancelled or expired.
-    """
-    def remaining( self ):
-        return max(0, self.expiry - time.monotonic())
-
-    """
-        Time elapsed since the start of the timeout, in seconds.
-    """
-    def elapsed( self ):
-        return time.monotonic() - self.start_time
-
-    """
-        Start or prolong the timeout, ensuring it will expire *at least* in "duration" seconds.
-        Returns the amount of time remaining.
-    """
-    def at_least( self, duration ):
-        return self.expire_at( max( self.expiry, time.monotonic() + duration ))
-
-    """
-        Shortens the timeout, ensuring it will expire *at most* in "duration" seconds.
-        Returns the amount of time remaining.
-    """
-    def at_most( self, duration ):
-        expiry = time.monotonic() + duration
-        if self.timer:
-            # If timeout was running, and more time remains than duration parameter, shorten it .
-            return self.expire_at( min( self.expiry, expiry ))
-        else:
-            # If timeout was not running, start it with duration parameter.
-            return self.expire_at( expiry )
-
-    """
-        If timeout is not active, start it with the specified duration.
-        If it was already running, adjust the duration.
-        Returns the amount of time remaining.
-    """
-    def set( self, duration ):
-        return self.expire_at( time.monotonic() + duration )
-
-    """
-        If timeout is not active, start it with the specified expiry time.
-        If it was already running:
-            ... with a different expiry time, cancel it and restart it with the new expiry.
-            ... with the same expiry time, just let it run.
-        Returns the amount of time remaining.
-    """
-    def expire_at( self, expiry ):
-        t = time.monotonic()
-        if self.timer:                      # timeout is active
-            if self.expiry == expiry:       # no change in expiry time: just return
-                return expiry - t
-            self.cancel()                   # cancel timeout to change the expiry
-        else:
-            self.start_time = t             # set start_time only of we do not modify a running timeout
-        duration = expiry - t
-        if duration <= 0:                   # expiry is in the past, don't bother with the timer
-            self.debug("DelayedCallback.expire_at: Direct callback %s", duration)
-            self.callback()
-            return 0
-        else:
-            self.debug("DelayedCallback.expire_at: Timer set to %s", duration)
-            self.expiry = expiry
-            self.timer = self.api.run_in( self._timer_callback, duration )
-            return duration
-
-    """
-        Cancels the timeout.
-        Does not call the callback.
-    """
-    def cancel( self ):
-        self.debug("DelayedCallback: Cancel timer %s", self.timer)
-        if self.timer:
-            self.api.cancel_timer( self.timer )
-            self.timer = None
-
-    """
-        Forget the expiry time so this timeout can no longer be extended
-    """
-    def reset( self ):
-        self.cancel()
-        self.expiry = 0
-
-    """
-        Called by the API timer when the timeout expires.
-    """
-    def _timer_callback( self, kwargs ):
-        self.timer = None
-        self.callback()
-    
-    def debug( self, fmt, *args ):
-        self.debug( fmt, *args, level="DEBUG" )
-
-"""
-    Same as DelayedCallbackF, with all times stored in UTC.
-    This is to save it to a file and reload it after reboot, 
-    can't do that with time.monotonic()
-"""
-class DelayedCallback( grug_persist.PersistMixin ):
-    def __init__( self, api, callback, entity_storage_id = None ):
-        self.api = api
-        self.callback = callback
-        self.timer = None       # If timer is not None, the timer is running and will trigger the callback
-        self.expiry = None      # Expiry is None when canceled.
-        self.start_ts = None  # Used to know for how long the timeout has been running. 
-        self.entity_storage_id = entity_storage_id
-
-    """
-        True if the timeout's callback will trigger in the future.
-        False if cancelled or paused.
-    """
-    def running( self ):
-        return bool( self.timer )
-
-    """
-        Remaining time in seconds.
-        0 if cancelled or expired.
-    """
-    def remaining( self ):
-        if self.expiry:
-            return max( 0, (self.expiry - self.api.get_now()).total_seconds() )
-        else:
-            return 0
-
-    """
-        Time elapsed since the start of the timeout, in seconds.
-    """
-    def elapsed( self ):
-        if self.start_ts:
-            return (self.api.get_now() - self.start_ts).total_seconds()
-        else:
-            return None
-
-    """
-        Start or prolong the timeout, ensuring it will expire *at least* in "duration" seconds.
-        Returns the amount of time remaining.
-    """
-    def at_least( self, duration ):
-        expiry = self.api.get_now() + datetime.timedelta(seconds=duration)
-        if self.expiry and self.expiry > expiry:
-            return self.expire_at( self.expiry )
-        else:
-            return self.expire_at( expiry )
-
-    """
-        Shortens the timeout, ensuring it will expire *at most* in "duration" seconds.
-        Returns the amount of time remaining.
-    """
-    def at_most( self, duration ):
-        expiry = self.api.get_now() + datetime.timedelta(seconds=duration)
-        if self.timer:
-            # If timeout was running, and more time remains than duration parameter, shorten it .
-            return self.expire_at( min( self.expiry, expiry ))
-        else:
-            # If timeout was not running, start it with duration parameter.
-            return self.expire_at( expiry )
-
-    """
-        If timeout is not active, start it with the specified duration.
-        If it was already running, adjust the duration.
-        Returns the amount of time remaining.
-    """
-    def set( self, duration ):
-        return self.expire_at( self.api.get_now() + datetime.timedelta(seconds=duration) )
-
-    """
-        If timeout is not active, start it with the specified expiry time.
-        If it was already running:
-            ... with a different expiry time, cancel it and restart it with the new expiry.
-            ... with the same expiry time, just let it run.
-        Returns the amount of time remaining.
-    """
-    def expire_at( self, expiry ):
-        now = self.api.get_now()
-        if self.timer:                      # timeout is active
-            if self.expiry == expiry:       # no change in expiry time: just return
-                return (expiry - now).total_seconds()
-            self.cancel()                   # cancel timeout to change the expiry
-        else:
-            self.start_ts = now             # set start_ts only of we do not modify a running timeout
-        duration = (expiry - now).total_seconds()
-        if expiry <= now:                   # expiry is in the past, don't bother with the timer
-            self.debug("DelayedCallback.expire_at: Direct callback %s", duration)
-            self.callback()
-            return 0
-        else:
-            self.debug("DelayedCallback.expire_at: Timer set to %s", duration)
-            self.expiry = expiry
-            self.timer = self.api.run_at( self._timer_callback, expiry )
-            self.save()
-            return duration
-
-    """
-        Cancels the timeout.
-        Does not call the callback.
-    """
-    def cancel( self ):
-        self.debug("DelayedCallback: Cancel timer %s", self.timer)
-        if self.timer:
-            self.api.cancel_timer( self.timer )
-            self.timer = None
-            self.save()
-
-    """
-        Forget the expiry time so this timeout can no longer be extended
-    """
-    def reset( self ):
-        self.cancel()
-        self.expiry = None
-        self.save()
-
-    """
-        Called by the API timer when the timeout expires.
-    """
-    def _timer_callback( self, kwargs ):
-        self.timer = None
-        self.save()
-        self.callback()
-    
-    def debug( self, fmt, *args ):
-        self.debug( fmt, *args, level="DEBUG" )
-    
-    def save( self ):
-        state = "on" if self.timer else "off"
-        attrs = { k:getattr( self, k ) for k in ("start_ts", "expiry") }
-        self._save( state, attrs )
-
-    def load( self ):
-        state, attrs = self._load()
-        if state == None:
-            return self.reset()
-        else:
-            self.start_ts = attrs["start_ts"]
-            self.expiry   = attrs["expiry"]
-            if state == "on":
-                self.expire_at( self.expiry )
-
-    def debug( self, fmt, *args ):
-        self.api.log( fmt, *args, level="DEBUG" )
-
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import appdaemon.plugins.hass.hassapi as hassapi
+import time, asyncio, datetime, json, heapq, itertools, weakref, threading, functools, traceback
+
+import grug_persist, grug_metrics, grug_command, grug_trace
+
+#   Timers work in monotonic seconds. Wall clock (UTC timestamp) is only
+#   used to persist and restore them.
+clock      = time.monotonic
+wall_clock = time.time
+
+_local = threading.local()
+
+"""
+    Current time in clock() seconds.
+    Inside a snapshot() callback, the time it started, so all timers touched
+    while handling one event agree on "now" and the clock is read once.
+"""
+def now():
+    t = getattr( _local, "now", None )
+    return clock() if t is None else t
+
+"""
+    Wrap a callback so now() is read once when it starts, and reused by
+    everything it calls. Nested snapshots keep the outer time.
+    Work queued with after() runs when the outermost snapshot returns,
+    then pending saves are flushed, see grug_persist.end_batch().
+"""
+def snapshot( func ):
+    def wrapper( *args, **kwargs ):
+        if getattr( _local, "now", None ) is not None:
+            return func( *args, **kwargs )
+        _local.now = clock()
+        _local.after = []
+        grug_persist.begin_batch()
+        try:
+            return func( *args, **kwargs )
+        finally:
+            try:
+                _run_after()
+            finally:
+                _local.now = None
+                _local.after = None
+                grug_persist.end_batch()
+    return wrapper
+
+"""
+    Call func( *args ) right after the current snapshot() callback, for
+    bookkeeping (timers, persistence, logging) that should not delay the
+    command sent for an event. Queued work runs in order, with the same
+    now(), and with the metrics of the actor that queued it. Outside a
+    snapshot() callback, func is called at once.
+"""
+def after( func, *args ):
+    queue = getattr( _local, "after", None )
+    if queue is None:
+        return func( *args )
+    if metrics := grug_metrics.current():
+        func = metrics.timed( func )
+    queue.append(( func, args ))
+
+def _run_after():
+    queue = _local.after
+    i = 0
+    while i < len( queue ):     # work may queue more work
+        func, args = queue[i]
+        func( *args )
+        i += 1
+
+"""
+    Convert between clock() seconds and UTC epoch seconds, for persistence.
+"""
+def to_epoch( t ):
+    if t is None:
+        return None
+    return round( wall_clock() + t - now(), 3 )
+
+def from_epoch( x ):
+    if x is None:
+        return None
+    return now() + x - wall_clock()
+
+"""
+    Persisted timer attributes, by schema version:
+
+    1   { "start_ts": datetime, "expiry": datetime }
+    2   { "v": 2, "start": epoch, "expiry": epoch }, UTC epoch seconds
+
+    Records embedding a timer (see Timeout.pack(), and the record of
+    motion_light_button) use the same keys.
+    migrate() brings attributes of any version to the current one.
+"""
+SCHEMA = 2
+
+def migrate( attrs ):
+    version = attrs.get( "v", 1 )
+    if version == SCHEMA:
+        return attrs
+    if version == 1:
+        start, expiry = attrs.get( "start_ts" ), attrs.get( "expiry" )
+        attrs = { k:v for k, v in attrs.items() if k not in ( "start_ts", "expiry" ) }
+        attrs.update( v=2, start=_v1_epoch( start ), expiry=_v1_epoch( expiry ))
+        return attrs
+    raise ValueError( "Unknown timer schema version %r" % version )
+
+#   Version 1 stored datetimes, which some stores return as ISO strings
+def _v1_epoch( dt ):
+    if dt is None:
+        return None
+    if isinstance( dt, str ):
+        dt = datetime.datetime.fromisoformat( dt )
+    return dt.timestamp()
+
+"""
+    Timer wheel shared by all DelayedCallback/DelayedCallbackF of an app.
+
+    Pending expiries are kept in a heap, and a single AppDaemon timer is
+    armed for the earliest one. Rescheduling a timeout that is not at the
+    head of the heap is O(log n) and does not touch the AppDaemon scheduler.
+
+    Entries are [deadline, seq, timeout]. Removing a timeout only marks its
+    entry dead (timeout=None), it is discarded when it reaches the head.
+    If the head moves later, the armed timer is left alone: it fires a bit
+    early, finds nothing to do and re-arms for the new head. Only an earlier
+    head requires cancel + re-arm.
+"""
+class TimerWheel:
+    EARLY = 0.01            # run timeouts due within this many seconds when the timer fires
+
+    def __init__( self, api ):
+        self.api    = api
+        self.heap   = []
+        self.seq    = itertools.count()
+        self.live   = 0     # number of entries in the heap that are not dead
+        self.handle = None  # AppDaemon timer handle, if armed
+        self.armed  = None  # deadline the AppDaemon timer is armed for
+
+    """
+        Schedule timeout._timer_callback() at deadline (clock() time).
+        Returns the heap entry, which the timeout keeps to unschedule itself.
+    """
+    def schedule( self, timeout, deadline ):
+        entry = [ deadline, next( self.seq ), timeout ]
+        heapq.heappush( self.heap, entry )
+        self.live += 1
+        self._arm()
+        return entry
+
+    """
+        Remove an entry returned by schedule(). Does not touch the AppDaemon timer.
+    """
+    def unschedule( self, entry ):
+        if entry and entry[2] is not None:
+            entry[2] = None
+            self.live -= 1
+            if len( self.heap ) > 64 and len( self.heap ) > 4 * self.live:
+                self.heap = [ e for e in self.heap if e[2] is not None ]
+                heapq.heapify( self.heap )
+
+    def _head( self ):
+        heap = self.heap
+        while heap and heap[0][2] is None:
+            heapq.heappop( heap )
+        return heap[0][0] if heap else None
+
+    def _arm( self ):
+        head = self._head()
+        if head is None:
+            return
+        if self.handle:
+            if self.armed <= head:      # fires early enough, will re-arm itself
+                return
+            self.api.cancel_timer( self.handle )
+        self.armed  = head
+        self.handle = self.api.run_in( self._fire, max( 0, head - now() ))
+
+    def _fire( self, kwargs ):
+        self.handle = None
+        self.armed  = None
+        try:
+            self._run_due()
+        finally:
+            self._arm()
+
+    #   A failing callback is logged and does not hold back the others:
+    #   they all share the AppDaemon timer of the wheel.
+    @snapshot
+    def _run_due( self ):
+        due  = now() + self.EARLY
+        heap = self.heap
+        while heap and heap[0][0] <= due:
+            entry = heapq.heappop( heap )
+            timeout = entry[2]
+            if timeout is not None:
+                entry[2] = None
+                self.live -= 1
+                try:
+                    timeout._timer_callback( None )
+                except Exception:
+                    self.api.log( "Timeout callback failed:\n%s", traceback.format_exc(), level="ERROR" )
+
+_wheels = weakref.WeakKeyDictionary()
+
+"""
+    Returns the TimerWheel of this app, creating it on first use.
+"""
+def get_wheel( api ):
+    wheel = _wheels.get( api )
+    if wheel is None:
+        wheel = _wheels[ api ] = TimerWheel( api )
+    return wheel
+
+"""
+    Calls the callback at the end of the timeout.
+    Timeout can be cancelled, prolonged, shortened.
+
+    It has 2 states:
+    - Expired:  timer=None, callback will not trigger
+    - Running:  timer valid, callback will trigger
+
+    expiry contains the expiration time (when the callback will be called),
+    in clock() seconds. It is not reset when the timeout is expired or
+    cancelled, only by reset().
+
+    This is the core shared by DelayedCallbackF and DelayedCallback.
+"""
+class Timeout:
+    def __init__( self, api, callback ):
+        self.api = api
+        self.callback = callback
+        self.wheel = get_wheel( api )
+        self.timer = None       # If timer is not None, the timer is running and will trigger the callback
+        self.expiry = None      # Expiry is None when canceled.
+        self.start_time = None  # Used to know for how long the timeout has been running.
+        self.restore = None     # RestoreQueue holding this timeout, if it expired during a restart
+
+    """
+        True if the timeout's callback will trigger in the future.
+        False if cancelled or paused.
+    """
+    def running( self ):
+        return bool( self.timer )
+
+    """
+        Remaining time in seconds.
+        0 if cancelled or expired.
+    """
+    def remaining( self ):
+        if self.expiry is None:
+            return 0
+        return max( 0, self.expiry - now() )
+
+    """
+        Time elapsed since the start of the timeout, in seconds.
+    """
+    def elapsed( self ):
+        if self.start_time is None:
+            return None
+        return now() - self.start_time
+
+    """
+        Start or prolong the timeout, ensuring it will expire *at least* in "duration" seconds.
+        Returns the amount of time remaining.
+    """
+    def at_least( self, duration ):
+        expiry = now() + duration
+        if self.expiry is not None and self.expiry > expiry:
+            return self.expire_at( self.expiry )
+        else:
+            return self.expire_at( expiry )
+
+    """
+        Shortens the timeout, ensuring it will expire *at most* in "duration" seconds.
+        Returns the amount of time remaining.
+    """
+    def at_most( self, duration ):
+        expiry = now() + duration
+        if self.timer:
+            # If timeout was running, and more time remains than duration parameter, shorten it .
+            return self.expire_at( min( self.expiry, expiry ))
+        else:
+            # If timeout was not running, start it with duration parameter.
+            return self.expire_at( expiry )
+
+    """
+        If timeout is not active, start it with the specified duration.
+        If it was already running, adjust the duration.
+        Returns the amount of time remaining.
+    """
+    def set( self, duration ):
+        return self.expire_at( now() + duration )
+
+    """
+        If timeout is not active, start it with the specified expiry time.
+        If it was already running:
+            ... with a different expiry time, cancel it and restart it with the new expiry.
+            ... with the same expiry time, just let it run.
+        Returns the amount of time remaining.
+    """
+    def expire_at( self, expiry ):
+        if self.restore:
+            self.restore.remove( self )
+        t = now()
+        if self.timer:                      # timeout is active
+            if self.expiry == expiry:       # no change in expiry time: just return
+                return expiry - t
+            self.cancel()                   # cancel timeout to change the expiry
+        else:
+            self.start_time = t             # set start_time only of we do not modify a running timeout
+        duration = expiry - t
+        if duration <= 0:                   # expiry is in the past, don't bother with the timer
+            self.debug("DelayedCallback.expire_at: Direct callback %s", duration)
+            self.callback()
+            return 0
+        else:
+            self.debug("DelayedCallback.expire_at: Timer set to %s", duration)
+            self.expiry = expiry
+            self.timer = self._schedule( expiry )
+            if metrics := grug_metrics.current():
+                metrics.reschedules += 1
+            self._changed()
+            return duration
+
+    """
+        Cancels the timeout.
+        Does not call the callback.
+    """
+    def cancel( self ):
+        self.debug("DelayedCallback: Cancel timer, expiry %s", self.expiry)
+        if self.restore:
+            self.restore.remove( self )
+        if self.timer:
+            self._unschedule()
+            self.timer = None
+            self._changed()
+
+    """
+        Forget the expiry time so this timeout can no longer be extended
+    """
+    def reset( self ):
+        self.cancel()
+        self.expiry = None
+        self._changed()
+
+    """
+        Called by the timer wheel when the timeout expires.
+    """
+    def _timer_callback( self, kwargs ):
+        self.timer = None
+        self._changed()
+        self.callback()
+
+    """
+        Persisted form of the timeout, in the current schema, without "v".
+        "on" is also true while it waits in the RestoreQueue.
+    """
+    def pack( self ):
+        return { "on":int( bool( self.timer or self.restore )), "start":to_epoch( self.start_time ), "expiry":to_epoch( self.expiry ) }
+
+    """
+        Restore from attributes in the current schema. A running timeout
+        whose expiry is past is queued for the RestoreQueue.
+    """
+    def unpack( self, attrs ):
+        self.start_time = from_epoch( attrs["start"] )
+        self.expiry     = from_epoch( attrs["expiry"] )
+        if attrs["on"] and self.expiry is not None:
+            if self.expiry > now():
+                self.expire_at( self.expiry )
+            else:
+                restore( self )
+
+    """
+        Live state of the timeout, in clock() seconds, for grug_handoff.
+    """
+    def hand_off( self ):
+        return { "on":bool( self.timer ), "queued":bool( self.restore ), "start":self.start_time, "expiry":self.expiry }
+
+    """
+        Resume from the state returned by hand_off() in the previous
+        instance of the app. The timer is armed as it was, so one that
+        expired in between fires as soon as the app is started, not from
+        initialize(). One waiting in the RestoreQueue is queued again.
+    """
+    def take_over( self, state ):
+        self.start_time = state["start"]
+        self.expiry     = state["expiry"]
+        if state["queued"]:
+            restore( self )
+        elif state["on"]:
+            self.timer = self._schedule( self.expiry )
+            self._changed()
+
+    """
+        Called when timer, expiry or start_time changed.
+    """
+    def _changed( self ):
+        pass
+
+    """
+        Arm the timer for expiry. Returns a handle stored in self.timer.
+    """
+    def _schedule( self, expiry ):
+        return self.wheel.schedule( self, expiry )
+
+    def _unschedule( self ):
+        self.wheel.unschedule( self.timer )
+
+    def debug( self, fmt, *args ):
+        grug_trace.trace( self.api, fmt, *args )
+
+"""
+    Timeout that is not persisted by itself.
+
+    on_change(), if given, is called when it changes, so its owner can
+    persist it within a record of its own with pack() and unpack().
+"""
+class DelayedCallbackF( Timeout ):
+    def __init__( self, api, callback, on_change = None ):
+        super().__init__( api, callback )
+        self.on_change = on_change
+        api.depends_on_module( grug_persist )
+
+    def _changed( self ):
+        if self.on_change:
+            self.on_change()
+
+"""
+    Same as DelayedCallbackF, persisted so it survives a restart, in an
+    entity of its own.
+    Times are converted to UTC only when saving and loading,
+    can't persist time.monotonic()
+"""
+class DelayedCallback( grug_persist.PersistMixin, Timeout ):
+    def __init__( self, api, callback, entity_storage_id = None ):
+        super().__init__( api, callback )
+        self.entity_storage_id = entity_storage_id
+
+    def _changed( self ):
+        self.save()
+
+    def save( self ):
+        attrs = self.pack()
+        state = "on" if attrs.pop( "on" ) else "off"
+        attrs[ "v" ] = SCHEMA
+        self._save( state, attrs )
+
+    def load( self ):
+        state, attrs = self._load()
+        if state == None:
+            return self.reset()
+        current = migrate( attrs )
+        self.unpack( dict( current, on=state == "on" ))
+        if current is not attrs:
+            self.save()         # store it in the current schema
+
+"""
+    Async variants of DelayedCallbackF and DelayedCallback.
+
+    The timer is a plain asyncio timer on the AppDaemon event loop, so the
+    callback runs on the loop without going through the AppDaemon scheduler
+    or a worker thread. Must be used from the event loop, ie from async
+    app callbacks, or sync functions called by them.
+"""
+class AsyncTimeoutMixin:
+    def _schedule( self, expiry ):
+        return asyncio.get_running_loop().call_later( expiry - now(), snapshot( self._timer_callback ), None )
+
+    def _unschedule( self ):
+        self.timer.cancel()
+
+class AsyncDelayedCallbackF( AsyncTimeoutMixin, DelayedCallbackF ):
+    pass
+
+class AsyncDelayedCallback( AsyncTimeoutMixin, DelayedCallback ):
+    pass
+
+"""
+    Catch-up of timeouts that expired while AppDaemon was down.
+
+    Timeout.unpack(), called by DelayedCallback.load(), does not call the
+    callback of such a timeout from initialize(), it queues the timeout
+    here. The queue starts when AppDaemon fires appd_started, after all
+    apps are initialized, or "restore_delay" seconds after the first
+    timeout was queued if it does not come (an app reloaded alone).
+
+    Callbacks then run in their own app, oldest expiry first, "restore_rate"
+    per second. Timeouts expired more than "restore_bulk_after" seconds ago
+    all run first, at once, and their plain turn_off() are sent as a single
+    bulk off.
+
+    A queued timeout that is set or cancelled before its turn is dropped.
+    Settings are read from the yaml config of the app arming the queue.
+"""
+class RestoreQueue:
+    def __init__( self ):
+        self.entries  = {}      # timeout -> None until started, then ( handle, BulkOff or None )
+        self.host     = None    # api of the start timer
+        self.handle   = None    # start timer handle
+        self.deadline = None    # clock() time of the start timer
+        self.started  = False
+        self.next_slot = None   # clock() time of the next free callback slot, once started
+
+    def add( self, timeout ):
+        timeout.restore = self
+        self.entries[ timeout ] = None
+        if self.started:
+            self._schedule( timeout )
+        elif self.host is None:
+            self._arm( timeout.api, timeout.api.args.get( "restore_delay", 30 ))
+
+    """
+        Drop a timeout from the queue, without calling its callback.
+    """
+    def remove( self, timeout ):
+        timeout.restore = None
+        if d := self.entries.pop( timeout, None ):
+            handle, bulk = d
+            self._cancel( timeout.api, handle )
+            if bulk:
+                bulk.done()
+        if not self.entries:
+            self._forget()
+
+    """
+        Drop the timeouts of an app, and hand the start timer over to
+        another app if it was armed by this one.
+    """
+    def unregister( self, api ):
+        for timeout in [ t for t in self.entries if t.api is api ]:
+            self.remove( timeout )
+        if self.entries and self.host is api and not self.started:
+            self._cancel( api, self.handle )
+            self._arm( next( iter( self.entries )).api, max( 0, self.deadline - now() ))
+
+    def _arm( self, api, delay ):
+        self.host       = api
+        self.rate       = api.args.get( "restore_rate", 2 )
+        self.bulk_after = api.args.get( "restore_bulk_after", 600 )
+        self.deadline   = now() + delay
+        self.handle     = self._call_later( api, delay, self._start )
+        self._listen( api, self._appd_started )
+
+    def _forget( self ):
+        if not self.started and self.handle is not None:
+            self._cancel( self.host, self.handle )
+        if _restores.get( type( self )) is self:
+            del _restores[ type( self ) ]
+
+    def _appd_started( self, event, data, kwargs ):
+        if not self.started and self.entries:
+            self._cancel( self.host, self.handle )
+            self._start()
+
+    @snapshot
+    def _start( self ):
+        self.started = True
+        self.handle  = None
+        t = now()
+        entries = sorted( self.entries, key=lambda timeout: timeout.expiry )
+        bulk = [ timeout for timeout in entries if t - timeout.expiry > self.bulk_after ]
+        self.host.log( "Restoring %d expired timers, %d in bulk", len( entries ), len( bulk ))
+        self.next_slot = t
+        if bulk:
+            off = grug_command.BulkOff( len( bulk ))
+            for timeout in bulk:
+                self.entries[ timeout ] = ( self._call_later( timeout.api, 0, functools.partial( self._run, timeout, off )), off )
+            self.next_slot += 1 / self.rate
+        for timeout in entries[ len( bulk ): ]:
+            self._schedule( timeout )
+
+    def _schedule( self, timeout ):
+        t = now()
+        self.next_slot = max( self.next_slot, t )
+        self.entries[ timeout ] = ( self._call_later( timeout.api, self.next_slot - t, functools.partial( self._run, timeout, None )), None )
+        self.next_slot += 1 / self.rate
+
+    @snapshot
+    def _run( self, timeout, bulk ):
+        if self.entries.pop( timeout, None ) is None:
+            return
+        timeout.restore = None
+        timeout.debug( "DelayedCallback: restored, expired %ss ago", now() - timeout.expiry )
+        if bulk:
+            bulk.run( timeout.api, functools.partial( timeout._timer_callback, None ))
+        else:
+            timeout._timer_callback( None )
+        if not self.entries:
+            self._forget()
+
+    #   AppDaemon scheduler and events, for apps running in worker threads
+
+    def _call_later( self, api, delay, func ):
+        return api.run_in( lambda kwargs: func(), delay )
+
+    def _cancel( self, api, handle ):
+        api.cancel_timer( handle )
+
+    def _listen( self, api, callback ):
+        api.listen_event( callback, "appd_started", namespace="global", oneshot=True )
+
+"""
+    Same as RestoreQueue, for timeouts of async apps: everything runs on
+    the event loop.
+"""
+class AsyncRestoreQueue( RestoreQueue ):
+    def _call_later( self, api, delay, func ):
+        return asyncio.get_running_loop().call_later( delay, func )
+
+    def _cancel( self, api, handle ):
+        handle.cancel()
+
+    def _listen( self, api, callback ):
+        api.listen_event( aio( callback ), "appd_started", namespace="global", oneshot=True )
+
+_restores = {}      # RestoreQueue class -> queue
+
+"""
+    Queue a timeout that expired while AppDaemon was down.
+"""
+def restore( timeout ):
+    cls = AsyncRestoreQueue if isinstance( timeout, AsyncTimeoutMixin ) else RestoreQueue
+    queue = _restores.get( cls )
+    if queue is None:
+        queue = _restores[ cls ] = cls()
+    queue.add( timeout )
+
+"""
+    Drop the queued restores of this app, call from terminate().
+"""
+def unregister( api ):
+    for queue in list( _restores.values() ):
+        queue.unregister( api )
+
+"""
+    Wrap a sync function into a coroutine function, so AppDaemon runs it as a
+    callback on the event loop instead of a worker thread.
+"""
+def aio( func ):
+    async def wrapper( *args, **kwargs ):
+        return func( *args, **kwargs )
+    return wrapper
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import collections, time, datetime
+
+import grug_metrics
+
+"""
+    Debug tracing for the actors and the shared modules.
+
+    Each actor registers a Tracer. Its debug messages are kept in a ring
+    buffer of the last "trace_size" (default 200) messages, as the format
+    string and its arguments: tracing costs a tuple append, formatting is
+    done only if the buffer is dumped.
+
+    To dump, fire the event "grug_trace" from Home Assistant (Developer
+    tools > Events), with { "actor": name } for a single actor, or no data
+    for all of them. Messages are written to the AppDaemon log of the app
+    hosting the listener, oldest first.
+
+    With "log_level: DEBUG" in the yaml config of an app, checked once
+    when its actors register, messages are also logged as they happen.
+
+    grug_timeout and grug_persist trace into the actor whose callback is
+    running (see grug_metrics.current()), else into the first actor of
+    their app.
+"""
+class Tracer:
+    def __init__( self, api, name, prefix="" ):
+        self.api     = api
+        self.name    = name
+        self.prefix  = prefix
+        self.ring    = collections.deque( maxlen=api.args.get( "trace_size", 200 ))
+        self.logging = api.args.get( "log_level" ) == "DEBUG"
+
+    def trace( self, fmt, *args ):
+        self.ring.append(( time.time(), fmt, args ))
+        if self.logging:
+            self.api.log( self.prefix + fmt, *args, level="DEBUG" )
+
+    """
+        Formatted messages in the buffer, oldest first.
+    """
+    def lines( self ):
+        lines = []
+        for t, fmt, args in list( self.ring ):
+            try:
+                msg = fmt % args
+            except ( TypeError, ValueError ):
+                msg = "%s %r" % ( fmt, args )
+            lines.append( "%s %s: %s" % ( datetime.datetime.fromtimestamp( t ).strftime( "%H:%M:%S.%f" )[:-3], self.name, msg ))
+        return lines
+
+_tracers = {}       # actor name -> Tracer
+_first   = {}       # api -> Tracer of its first actor
+_host    = None     # api listening for the dump event
+_handle  = None
+
+"""
+    Register an actor and return its Tracer. prefix is prepended to the
+    messages logged as they happen.
+"""
+def register( api, name, prefix="" ):
+    tracer = _tracers[ name ] = Tracer( api, name, prefix )
+    _first.setdefault( api, tracer )
+    if _host is None:
+        _listen( api )
+    return tracer
+
+"""
+    Remove the actors of this app, call from terminate().
+    If it was listening for dumps, another registered app takes over.
+"""
+def unregister( api ):
+    global _host, _handle
+    for name, tracer in list( _tracers.items() ):
+        if tracer.api is api:
+            del _tracers[ name ]
+    _first.pop( api, None )
+    if _host is api:
+        _host = _handle = None      # AppDaemon drops the listeners of a terminated app
+        if _first:
+            _listen( next( iter( _first )))
+
+"""
+    Trace a debug message from a shared module working for an app.
+"""
+def trace( api, fmt, *args ):
+    metrics = grug_metrics.current()
+    tracer = _tracers.get( metrics.name ) if metrics else None
+    if tracer is None and (tracer := _first.get( api )) is None:
+        return
+    tracer.trace( fmt, *args )
+
+"""
+    Log the buffers of all actors, or of the actor called name.
+"""
+def dump( name=None ):
+    if _host is None:
+        return
+    for tracer in list( _tracers.values() ):
+        if name is None or tracer.name == name:
+            for line in tracer.lines():
+                _host.log( "%s", line )
+
+def _listen( api ):
+    global _host, _handle
+    _host = api
+    _handle = api.listen_event( _on_dump, "grug_trace" )
+
+def _on_dump( event, data, kwargs ):
+    dump(( data or {} ).get( "actor" ))
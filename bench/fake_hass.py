@@ -0,0 +1,369 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+    In-process stand-in for the parts of AppDaemon the apps use, with a
+    virtual clock, so they can be run and measured without Home Assistant.
+
+    install() registers a fake appdaemon.plugins.hass.hassapi module and
+    puts the apps directories on sys.path, like AppDaemon does. After that,
+    app modules import normally and their hassapi.Hass base is FakeHass.
+
+    All apps share one World: entity states per namespace, listeners, the
+    virtual clock and call counters. Timers only fire when the clock is
+    advanced with World.run_until() / World.advance().
+
+    Service calls (turn_on/turn_off/call_service) update the entity state
+    after "echo_delay" virtual seconds, like HA reporting the new state back.
+"""
+import sys, os, types, datetime, heapq, itertools, collections, tempfile, json
+
+APPS_DIR = os.path.join( os.path.dirname( os.path.dirname( os.path.abspath( __file__ ))), "apps" )
+EPOCH    = datetime.datetime( 2026, 1, 1, tzinfo=datetime.timezone.utc )
+
+#   Counter categories, see World.count()
+SCHEDULER = ( "run_in", "run_at", "run_every", "cancel_timer" )
+SERVICES  = ( "turn_on", "turn_off", "call_service", "mqtt_publish" )
+
+class VirtualClock:
+    def __init__( self, start=EPOCH ):
+        self.t      = 0.0
+        self.start  = start
+        self.queue  = []        # [ t, seq, func, args ], func is None when cancelled
+        self.seq    = itertools.count()
+
+    def monotonic( self ):
+        return self.t
+
+    def now( self ):
+        return self.start + datetime.timedelta( seconds=self.t )
+
+    def call_at( self, t, func, *args ):
+        entry = [ max( t, self.t ), next( self.seq ), func, args ]
+        heapq.heappush( self.queue, entry )
+        return entry
+
+    def cancel( self, entry ):
+        entry[2] = None
+
+    """
+        Run everything scheduled up to time t, in order, then set the clock to t.
+    """
+    def run_until( self, t ):
+        queue = self.queue
+        while queue and queue[0][0] <= t:
+            when, seq, func, args = heapq.heappop( queue )
+            if func is not None:
+                self.t = when
+                func( *args )
+        self.t = max( self.t, t )
+
+class World:
+    def __init__( self, echo_delay=0.05 ):
+        self.clock      = VirtualClock()
+        self.echo_delay = echo_delay
+        self.states     = collections.defaultdict( dict )   # namespace -> entity_id -> { state, attributes }
+        self.listeners  = collections.defaultdict( list )   # ( namespace, entity_id ) -> [ [ callback, kwargs ] ]
+        self.events     = []                                # [ callback, event, kwargs ]
+        self.services   = []                                # ( t, service, entity_id, kwargs )
+        self.counters   = collections.Counter()
+        self.handles    = itertools.count( 1 )
+        self.threads    = itertools.count()                 # round-robin thread of unpinned apps
+        self.mqtt       = FakeMqtt( self )
+        self.log_lines  = []
+        self.print_log  = False
+        self.config_dir = tempfile.mkdtemp( prefix="grug_bench_" )
+        self.app_config = {}                                # apps.yaml, as AppDaemon gives it to every app
+
+    def count( self, *names ):
+        return sum( self.counters[ n ] for n in names )
+
+    def advance( self, dt ):
+        self.clock.run_until( self.clock.t + dt )
+
+    def run_until( self, t ):
+        self.clock.run_until( t )
+
+    """
+        Set an entity state and call its listeners, like a state change from HA.
+    """
+    def set_entity( self, entity_id, state, attributes=None, namespace="default" ):
+        ns  = self.states[ namespace ]
+        old = ns.get( entity_id )
+        ns[ entity_id ] = { "entity_id":entity_id, "state":state, "attributes":dict( attributes or {} ) }
+        old_state = old[ "state" ] if old else None
+        if old_state != state:
+            for callback, kwargs in list( self.listeners[ namespace, entity_id ] ):
+                callback( entity_id, "state", old_state, state, kwargs )
+
+    def fire_event( self, event, data ):
+        for callback, name, kwargs in list( self.events ):
+            if name == event and all( data.get( k ) == v for k, v in kwargs.items() if k in data ):
+                callback( event, data, kwargs )
+
+    def service( self, service, entity_id, kwargs ):
+        self.services.append(( self.clock.t, service, entity_id, kwargs ))
+        if entity_id is None:
+            return
+        for e in ( [entity_id] if isinstance( entity_id, str ) else entity_id ):
+            state = "on" if service.endswith( "turn_on" ) else "off"
+            attrs = { k:v for k, v in kwargs.items() if k != "transition" }
+            self.clock.call_at( self.clock.t + self.echo_delay, self.set_entity, e, state, attrs )
+
+class Entity:
+    def __init__( self, world, entity_id, namespace ):
+        self.world, self.entity_id, self.namespace = world, entity_id, namespace
+
+    def add( self, state=None, attributes=None ):
+        self.world.counters[ "entity_add" ] += 1
+        self.world.states[ self.namespace ].setdefault( self.entity_id,
+            { "entity_id":self.entity_id, "state":state, "attributes":dict( attributes or {} ) } )
+
+    def exists( self ):
+        return self.entity_id in self.world.states[ self.namespace ]
+
+"""
+    Stand-in for the MQTT plugin and broker, and for zigbee2mqtt: devices
+    maps a device topic ("z2m/lamp") to the entity it is exposed as in HA,
+    or a group topic to the list of its members. A message on
+    "<device topic>/set" updates the entities after echo_delay, like the
+    MQTT integration reporting the new state back.
+"""
+class FakeMqtt:
+    def __init__( self, world ):
+        self.world     = world
+        self.published = []     # ( t, topic, payload )
+        self.devices   = {}     # device topic -> entity_id, or list of them for a group
+
+    def listen_event( self, callback, event, **kwargs ):
+        self.world.counters[ "listen_event" ] += 1
+        self.world.events.append([ callback, event, kwargs ])
+        return next( self.world.handles )
+
+    def is_client_connected( self ):
+        return True
+
+    def mqtt_publish( self, topic, payload=None, **kwargs ):
+        self.world.counters[ "mqtt_publish" ] += 1
+        self.published.append(( self.world.clock.t, topic, payload ))
+        device, _, command = topic.rpartition( "/" )
+        if command == "set" and (entity_id := self.devices.get( device )):
+            d = json.loads( payload )
+            state = d.pop( "state" ).lower()
+            d.pop( "transition", None )
+            for e in ( [entity_id] if isinstance( entity_id, str ) else entity_id ):
+                self.world.clock.call_at( self.world.clock.t + self.world.echo_delay, self.world.set_entity, e, state, d )
+
+    """
+        Deliver a message to listeners, honouring topic and wildcard filters.
+    """
+    def receive( self, topic, payload ):
+        data = { "topic":topic, "payload":payload }
+        for callback, event, kwargs in list( self.world.events ):
+            if event != "MQTT_MESSAGE":
+                continue
+            if "topic" in kwargs and kwargs[ "topic" ] != topic:
+                continue
+            if "wildcard" in kwargs and not topic_matches( kwargs[ "wildcard" ], topic ):
+                continue
+            callback( event, data, kwargs )
+
+def topic_matches( pattern, topic ):
+    p, t = pattern.split( "/" ), topic.split( "/" )
+    for i, level in enumerate( p ):
+        if level == "#":
+            return True
+        if i >= len( t ) or ( level != "+" and level != t[i] ):
+            return False
+    return len( p ) == len( t )
+
+_world = None
+
+THREADS = 10        # AppDaemon's default total_threads
+
+"""
+    Stand-in for hassapi.Hass. Like AppDaemon, apps run on the thread set
+    with "pin_thread" in their yaml config, else on threads given in turn.
+"""
+class FakeHass:
+    def __init__( self, name, args=None ):
+        self.world      = _world
+        self.name       = name
+        self.args       = dict( args or {} )
+        self.args.setdefault( "name", name )
+        self.namespace  = "default"
+        self.pin_thread = self.args.get( "pin_thread", next( self.world.threads ) % THREADS )
+        self.handles    = {}
+        self.config_dir = self.world.config_dir
+        self.app_config = self.world.app_config
+
+    #   Logging
+
+    def log( self, fmt, *args, level="INFO" ):
+        self.world.counters[ "log" ] += 1
+        if level != "DEBUG" or self.args.get( "log_level" ) == "DEBUG":
+            line = "%s %s: %s" % ( level, self.name, fmt % args if args else fmt )
+            self.world.log_lines.append( line )
+            if self.world.print_log:
+                print( line )
+
+    def depends_on_module( self, *modules ):
+        pass
+
+    def get_pin_thread( self ):
+        return self.pin_thread
+
+    #   Scheduler
+
+    def get_now( self ):
+        self.world.counters[ "get_now" ] += 1
+        return self.world.clock.now()
+
+    def run_in( self, callback, delay, **kwargs ):
+        self.world.counters[ "run_in" ] += 1
+        return self._timer( self.world.clock.t + delay, callback, kwargs )
+
+    def run_at( self, callback, when, **kwargs ):
+        self.world.counters[ "run_at" ] += 1
+        return self._timer( self.world.clock.t + ( when - self.world.clock.now() ).total_seconds(), callback, kwargs )
+
+    def run_every( self, callback, start, interval, **kwargs ):
+        self.world.counters[ "run_every" ] += 1
+        handle = next( self.world.handles )
+        t = self.world.clock.t if start == "now" else self.world.clock.t + ( start - self.world.clock.now() ).total_seconds()
+        def fire():
+            self.handles[ handle ] = self.world.clock.call_at( self.world.clock.t + interval, fire )
+            callback( kwargs )
+        self.handles[ handle ] = self.world.clock.call_at( t, fire )
+        return handle
+
+    def _timer( self, t, callback, kwargs ):
+        handle = next( self.world.handles )
+        def fire():
+            self.handles.pop( handle, None )
+            callback( kwargs )
+        self.handles[ handle ] = self.world.clock.call_at( t, fire )
+        return handle
+
+    def cancel_timer( self, handle ):
+        self.world.counters[ "cancel_timer" ] += 1
+        if entry := self.handles.pop( handle, None ):
+            self.world.clock.cancel( entry )
+
+    def timer_running( self, handle ):
+        return handle in self.handles
+
+    #   State
+
+    def get_namespace( self ):
+        self.world.counters[ "get_namespace" ] += 1
+        return self.namespace
+
+    def set_namespace( self, namespace ):
+        self.world.counters[ "set_namespace" ] += 1
+        self.namespace = namespace
+
+    def get_state( self, entity_id=None, attribute=None, default=None, namespace=None, **kwargs ):
+        self.world.counters[ "get_state" ] += 1
+        ns = self.world.states[ namespace or self.namespace ]
+        if entity_id is None:
+            return { k:dict( v ) for k, v in ns.items() }
+        d = ns.get( entity_id )
+        if d is None:
+            return default
+        if attribute == "all":
+            return dict( d )
+        if attribute:
+            return d[ "attributes" ].get( attribute, default )
+        return d[ "state" ]
+
+    def set_state( self, entity_id, state=None, attributes=None, namespace=None, **kwargs ):
+        namespace = namespace or self.namespace
+        self.world.counters[ "set_state" ] += 1
+        if namespace == "userapps":
+            self.world.counters[ "persist_write" ] += 1
+            self.world.counters[ "persist_bytes" ] += len( repr( attributes )) + len( str( state ))
+        self.world.set_entity( entity_id, state, attributes, namespace )
+
+    def get_entity( self, entity_id, namespace=None ):
+        return Entity( self.world, entity_id, namespace or self.namespace )
+
+    def entity_exists( self, entity_id, namespace=None ):
+        return entity_id in self.world.states[ namespace or self.namespace ]
+
+    def listen_state( self, callback, entity_id, namespace=None, **kwargs ):
+        self.world.counters[ "listen_state" ] += 1
+        entry = [ callback, kwargs ]
+        self.world.listeners[ namespace or "default", entity_id ].append( entry )
+        handle = next( self.world.handles )
+        self.handles[ handle ] = ( namespace or "default", entity_id, entry )
+        return handle
+
+    def cancel_listen_state( self, handle ):
+        self.world.counters[ "cancel_listen_state" ] += 1
+        if d := self.handles.pop( handle, None ):
+            namespace, entity_id, entry = d
+            self.world.listeners[ namespace, entity_id ].remove( entry )
+
+    #   Events and services
+
+    def listen_event( self, callback, event, **kwargs ):
+        self.world.counters[ "listen_event" ] += 1
+        self.world.events.append([ callback, event, kwargs ])
+        return next( self.world.handles )
+
+    def fire_event( self, event, **kwargs ):
+        self.world.counters[ "fire_event" ] += 1
+        self.world.fire_event( event, kwargs )
+
+    def register_service( self, service, callback, **kwargs ):
+        self.world.counters[ "register_service" ] += 1
+
+    def call_service( self, service, **kwargs ):
+        self.world.counters[ "call_service" ] += 1
+        self.world.service( service, kwargs.pop( "entity_id", None ), kwargs )
+
+    def turn_on( self, entity_id, **kwargs ):
+        self.world.counters[ "turn_on" ] += 1
+        self.world.service( entity_id.split( "." )[0] + "/turn_on", entity_id, kwargs )
+
+    def turn_off( self, entity_id, **kwargs ):
+        self.world.counters[ "turn_off" ] += 1
+        self.world.service( entity_id.split( "." )[0] + "/turn_off", entity_id, kwargs )
+
+    def get_plugin_api( self, name ):
+        return self.world.mqtt
+
+"""
+    Install the fake AppDaemon modules and the apps directories on sys.path.
+"""
+def install():
+    if "appdaemon.plugins.hass.hassapi" not in sys.modules:
+        for name in ( "appdaemon", "appdaemon.plugins", "appdaemon.plugins.hass" ):
+            sys.modules.setdefault( name, types.ModuleType( name ))
+        hassapi = types.ModuleType( "appdaemon.plugins.hass.hassapi" )
+        hassapi.Hass = FakeHass
+        sys.modules[ "appdaemon.plugins.hass.hassapi" ] = hassapi
+    for d in sorted( os.listdir( APPS_DIR )):
+        path = os.path.join( APPS_DIR, d )
+        if os.path.isdir( path ) and path not in sys.path:
+            sys.path.insert( 0, path )
+
+"""
+    Start a fresh World and re-import the shared and app modules, so module
+    level caches start empty, like after an AppDaemon restart.
+    Returns the World.
+"""
+def new_world( **kwargs ):
+    global _world
+    install()
+    for name in list( sys.modules ):
+        if name.startswith( "grug_" ) or name in ( "motion_light_button", "motion_light_fade", "multi_timer" ):
+            del sys.modules[ name ]
+    _world = World( **kwargs )
+    import grug_timeout
+    grug_timeout.clock = _world.clock.monotonic
+    import grug_command
+    grug_command.clock = _world.clock.monotonic
+    grug_timeout.wall_clock = lambda: _world.clock.now().timestamp()
+    return _world
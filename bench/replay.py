@@ -0,0 +1,209 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+    Replay an event stream through the apps on the fake AppDaemon of
+    fake_hass.py and report the work done per event.
+
+    python bench/replay.py                          synthetic stream
+    python bench/replay.py --stream events.jsonl    recorded stream
+    python bench/replay.py --check bench/baseline.json
+    python bench/replay.py --save bench/baseline.json
+
+    A recorded stream has one JSON object per line, sorted by time:
+        { "t": 12.5, "entity": "binary_sensor.dm1", "state": "on" }
+        { "t": 30.0, "topic": "z2m/b5/action", "payload": "1_single" }
+
+    --check exits with status 1 if any per-event counter is higher than in
+    the baseline file (plus --tolerance), so regressions in the hot paths
+    show up before deployment.
+"""
+import sys, os, json, time, random, argparse
+
+sys.path.insert( 0, os.path.dirname( os.path.abspath( __file__ )))
+import fake_hass
+
+FADE = [
+    { "fade_time":0.5, "brightness":255, "wait_time":120 },
+    { "fade_time":2,   "brightness":128, "wait_time":300 },
+    { "fade_time":2,   "brightness":3,   "wait_time":300 },
+    { "fade_time":2,   "brightness":0,   "wait_time":1 },
+]
+
+"""
+    Create the apps, like apps.yaml does. Returns ( apps, sensors, lights, topics ).
+"""
+def setup( world, rooms, backend="namespace", hosted=False, debounce=0, mqtt=False, bulbs=1 ):
+    import motion_light_button, motion_light_fade, multi_timer
+    import grug_persist
+    world.app_config[ "grug_persist" ] = { "module":"grug_persist", "global":True, "persist_backend":backend }
+    store = grug_persist.get_backend( fake_hass.FakeHass( "bench" ))
+    if backend == "journal":
+        # count journal records as persistence writes, like set_state in userapps
+        write, commit = store.write, store.commit
+        def counted_write( api, items, creates ):
+            world.counters[ "persist_write" ] += len( items )
+            write( api, items, creates )
+        def counted_commit():
+            world.counters[ "fsync" ] += 1 if store.pending else 0
+            commit()
+        store.write, store.commit = counted_write, counted_commit
+    sensors = [ "binary_sensor.dm%d_occupancy" % i for i in range( rooms+2 ) ]
+    apps = []
+    # the apps sharing sensors are pinned to one thread, as in apps.yaml, to share a grug_sensors hub
+    apps.append( motion_light_button.MotionLightButton( "lumiere_escalier", {
+        "sensors":sensors[:3], "light":"switch.escalier", "motion_delay":120, "button_delay":3600, "timeout":20000, "debounce":debounce, "pin_thread":0 }))
+    configs = [ { "name":"lumiere_%d" % i, "sensors":sensors[i:i+2], "light":"light.room_%d" % i, "fade":FADE, "debounce":debounce } for i in range( rooms ) ]
+    if bulbs > 1:
+        for i, c in enumerate( configs ):
+            c[ "light" ] = [ "light.room_%d_%d" % ( i, j ) for j in range( bulbs ) ]
+    outputs = {}
+    if mqtt and bulbs > 1:
+        # one zigbee2mqtt group per room
+        for i, c in enumerate( configs ):
+            c[ "group" ] = "light.room_%d" % i
+            outputs[ c["group"] ] = "z2m/room_%d" % i
+            world.mqtt.devices[ outputs[ c["group"] ]] = c[ "light" ]
+    elif mqtt:
+        # drive the fade lights through the zigbee2mqtt stand-in
+        outputs = { c["light"]:"z2m/" + c["light"].split( "." )[1] for c in configs }
+        world.mqtt.devices.update( { topic:entity_id for entity_id, topic in outputs.items() } )
+    if hosted:
+        apps.append( motion_light_fade.MotionLightFade( "lumiere", { "rooms":configs, "mqtt_outputs":outputs, "pin_thread":0 } ))
+    else:
+        apps.extend( motion_light_fade.MotionLightFade( c["name"], dict( c, mqtt_outputs=outputs, pin_thread=0 )) for c in configs )
+    apps.append( multi_timer.MultiTimer( "charge", {
+        "output_switch":"switch.charge",
+        "trigger_topics":{ "z2m/+/action":{ "1_single":{ "on_time":3600 }, "2_single":{ "on_time":60 }, "4_single":{ "state":"off" }}}}))
+    for app in apps:
+        app.initialize()
+    return apps, sensors, [ "switch.escalier" ], [ "z2m/b%d/action" % i for i in range( 4 ) ]
+
+"""
+    Synthetic stream: motion pulses on random sensors, some wired button
+    presses on the stairwell relay and some MQTT button actions.
+"""
+def synthetic( count, sensors, lights, topics, seed=1 ):
+    rnd, t, events = random.Random( seed ), 0.0, []
+    while len( events ) < count:
+        t += rnd.expovariate( 1/20 )
+        r = rnd.random()
+        if r < 0.85:
+            sensor = rnd.choice( sensors )
+            events.append({ "t":t, "entity":sensor, "state":"on" })
+            events.append({ "t":t + rnd.uniform( 5, 90 ), "entity":sensor, "state":rnd.choice(( "off", "off", "off", "unavailable" )) })
+        elif r < 0.93:
+            light = rnd.choice( lights )
+            events.append({ "t":t, "entity":light, "state":rnd.choice(( "on", "off" )) })
+        else:
+            events.append({ "t":t, "topic":rnd.choice( topics ), "payload":rnd.choice(( "1_single", "2_single", "4_single", "3_double" )) })
+    events.sort( key=lambda e: e["t"] )
+    return events[:count]
+
+def load_stream( path ):
+    with open( path ) as f:
+        return [ json.loads( line ) for line in f if line.strip() ]
+
+def replay( world, events ):
+    for e in events:
+        world.run_until( e["t"] )
+        if "entity" in e:
+            world.set_entity( e["entity"], e["state"], e.get( "attributes" ))
+        else:
+            world.mqtt.receive( e["topic"], e["payload"] )
+    world.advance( 24*3600 )    # let all timers run out
+
+def report( world, events, elapsed, rooms, subscriptions ):
+    c, n = world.counters, max( 1, len( events ))
+    return {
+        "events":               len( events ),
+        "rooms":                rooms,
+        "events_per_sec":       round( n / elapsed ) if elapsed else None,
+        "scheduler_per_event":  round( world.count( *fake_hass.SCHEDULER ) / n, 3 ),
+        "persist_per_event":    round( c[ "persist_write" ] / n, 3 ),
+        "persist_bytes_per_event": round( c[ "persist_bytes" ] / n, 1 ),
+        "services_per_event":   round( world.count( *fake_hass.SERVICES ) / n, 3 ),
+        "get_state_per_event":  round( c[ "get_state" ] / n, 3 ),
+        "get_now_per_event":    round( c[ "get_now" ] / n, 3 ),
+        "log_per_event":        round( c[ "log" ] / n, 3 ),
+        "latency_us":           mean_us( "latency_ms" ),
+        "callback_us":          mean_us( "callback_ms" ),
+        "listen_state":         subscriptions,
+    }
+
+"""
+    Mean of a grug_metrics histogram over all actors, in microseconds of
+    real time: latency_ms, from input event to first command sent, or
+    callback_ms, the time spent in each callback. Not checked against the
+    baseline, compare them between runs on the same machine.
+"""
+def mean_us( histogram ):
+    import grug_metrics
+    count = total = 0
+    for api, m in grug_metrics._registry.values():
+        h = getattr( m, histogram )
+        count += h.count
+        total += h.total
+    return round( total / count * 1000, 1 ) if count else None
+
+"""
+    Compare per-event counters with a baseline. Returns the list of regressions.
+"""
+def check( result, baseline, tolerance ):
+    failed = []
+    for k, v in baseline.items():
+        if k.endswith( "_per_event" ) and k in result and result[k] > v * ( 1 + tolerance ) + 1e-9:
+            failed.append( "%s: %s > baseline %s" % ( k, result[k], v ))
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser( description="Replay events through the apps on a fake AppDaemon" )
+    parser.add_argument( "--stream", help="recorded stream, JSON lines" )
+    parser.add_argument( "--events", type=int, default=20000, help="synthetic stream length" )
+    parser.add_argument( "--rooms", type=int, default=3, help="number of fade rooms" )
+    parser.add_argument( "--seed", type=int, default=1 )
+    parser.add_argument( "--backend", default="namespace", help="grug_persist backend: namespace or journal" )
+    parser.add_argument( "--hosted", action="store_true", help="host all fade rooms in a single app" )
+    parser.add_argument( "--debounce", type=float, default=0, help="sensor debounce window, seconds" )
+    parser.add_argument( "--mqtt", action="store_true", help="drive the fade lights over MQTT" )
+    parser.add_argument( "--bulbs", type=int, default=1, help="lights per fade room, in a zigbee2mqtt group with --mqtt" )
+    parser.add_argument( "--check", help="baseline json, exit 1 on regression" )
+    parser.add_argument( "--save", help="write result as new baseline" )
+    parser.add_argument( "--tolerance", type=float, default=0.05 )
+    parser.add_argument( "--log", action="store_true", help="print app logs" )
+    parser.add_argument( "--metrics", action="store_true", help="print the grug.metrics entity" )
+    args = parser.parse_args()
+
+    world = fake_hass.new_world()
+    world.print_log = args.log
+    apps, sensors, lights, topics = setup( world, args.rooms, args.backend, args.hosted, args.debounce, args.mqtt, args.bulbs )
+    events = load_stream( args.stream ) if args.stream else synthetic( args.events, sensors, lights, topics, args.seed )
+    subscriptions = world.counters[ "listen_state" ]
+    world.counters.clear()
+
+    start = time.perf_counter()
+    replay( world, events )
+    result = report( world, events, time.perf_counter() - start, args.rooms, subscriptions )
+    if args.metrics:
+        import grug_metrics
+        grug_metrics.publish()
+        print( json.dumps( world.states[ "userapps" ][ grug_metrics.ENTITY ][ "attributes" ], indent=2 ))
+    for app in apps:
+        app.terminate()
+
+    for k, v in result.items():
+        print( "%-26s %s" % ( k, v ))
+    if args.save:
+        with open( args.save, "w" ) as f:
+            json.dump( result, f, indent=2 )
+            f.write( "\n" )
+    if args.check:
+        with open( args.check ) as f:
+            failed = check( result, json.load( f ), args.tolerance )
+        for line in failed:
+            print( "REGRESSION", line )
+        return 1 if failed else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit( main() )